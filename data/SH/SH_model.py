@@ -1,32 +1,74 @@
 import akshare as ak
+import atexit
 import sqlite3
 from datetime import datetime
 import pandas as pd
 import os
 
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# 上证指数表结构，date为YYYY-MM-DD文本
+SH_INDEX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        date TEXT PRIMARY KEY,
+        open REAL,
+        high REAL,
+        low REAL,
+        close REAL,
+        volume REAL
+    ) WITHOUT ROWID
+'''
+
 class StockDataModel:
     def __init__(self, db_path='data/SH/SH_data.db'):
         # 确保目录存在
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self.db_path = db_path
+        # 安装了pyarrow时额外维护一份Parquet列式副本，供按列分析读取
+        self.parquet_path = os.path.splitext(db_path)[0] + '.parquet'
+        # 所有方法复用同一个连接，保持页缓存常驻
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA cache_size=-65536')
+        atexit.register(self.close)
         self._init_db()
 
+    def close(self):
+        """关闭数据库连接"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
     def _init_db(self):
         """初始化数据库表结构"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sh_index (
-                date TEXT PRIMARY KEY,
-                open REAL,
-                high REAL,
-                low REAL,
-                close REAL,
-                volume REAL
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        cursor = self._conn.cursor()
+        # WAL模式写入数据库文件，只需设置一次
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # WITHOUT ROWID 使表本身按日期主键组织，按日期范围查询无需再回表
+        cursor.execute(SH_INDEX_SCHEMA.format(table='sh_index'))
+        self._conn.commit()
+        self._migrate_without_rowid()
+
+    def _migrate_without_rowid(self):
+        """将旧版带rowid的sh_index表重建为WITHOUT ROWID表"""
+        row = self._conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'sh_index'"
+        ).fetchone()
+        if row is None or 'WITHOUT ROWID' in row[0].upper():
+            return
+        with self._conn:
+            self._conn.execute('DROP TABLE IF EXISTS sh_index_new')
+            self._conn.execute(SH_INDEX_SCHEMA.format(table='sh_index_new'))
+            self._conn.execute('''
+                INSERT OR REPLACE INTO sh_index_new (date, open, high, low, close, volume)
+                SELECT date, open, high, low, close, volume FROM sh_index
+            ''')
+            self._conn.execute('DROP TABLE sh_index')
+            self._conn.execute('ALTER TABLE sh_index_new RENAME TO sh_index')
 
     def fetch_sh_index_data(self):
         """从akshare获取上证指数数据"""
@@ -42,31 +84,53 @@ class StockDataModel:
         if df is None or df.empty:
             return False
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # 准备数据
-        data = df[['date', 'open', 'high', 'low', 'close', 'volume']].values.tolist()
+        # 准备数据，日期统一为YYYY-MM-DD文本
+        data = df[['date', 'open', 'high', 'low', 'close', 'volume']].copy()
+        data['date'] = pd.to_datetime(data['date'], format='ISO8601', cache=True).dt.strftime('%Y-%m-%d')
 
-        # 使用批量插入
-        cursor.executemany('''
-            INSERT OR REPLACE INTO sh_index (date, open, high, low, close, volume)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', data)
+        # 显式开启写事务，写入临时表、合并到正式表与删除临时表在同一事务中完成，出错时整体回滚；
+        # to_sql 会在中途自行提交，因此临时表用 executemany 写入
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('''
+                CREATE TEMP TABLE sh_index_staging (
+                    date TEXT, open REAL, high REAL, low REAL, close REAL, volume REAL
+                )
+            ''')
+            self._conn.executemany('INSERT INTO sh_index_staging VALUES (?, ?, ?, ?, ?, ?)',
+                                   data.itertuples(index=False, name=None))
+            self._conn.execute('''
+                INSERT OR REPLACE INTO sh_index (date, open, high, low, close, volume)
+                SELECT date, open, high, low, close, volume FROM sh_index_staging
+            ''')
+            self._conn.execute('DROP TABLE sh_index_staging')
 
-        conn.commit()
-        conn.close()
+        if PARQUET_AVAILABLE:
+            self._export_parquet()
         return True
 
+    def _export_parquet(self):
+        """将sh_index整表导出为Parquet文件"""
+        df = pd.read_sql_query('SELECT * FROM sh_index ORDER BY date', self._conn,
+                               parse_dates={'date': {'format': '%Y-%m-%d'}})
+        df.to_parquet(self.parquet_path, engine='pyarrow', compression='zstd', index=False)
+
     def get_latest_data(self, limit=10):
         """获取最新的数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self._conn.cursor()
+        # 一次取回全部结果行，避免按默认arraysize逐行往返
+        cursor.arraysize = max(1, min(limit, 1024))
         cursor.execute('''
             SELECT * FROM sh_index
             ORDER BY date DESC
             LIMIT ?
         ''', (limit,))
-        data = cursor.fetchall()
-        conn.close()
-        return data 
\ No newline at end of file
+        return cursor.fetchmany(limit)
+
+    def get_latest_df(self, limit=10):
+        """获取最新的数据，以DataFrame形式返回，供分析使用"""
+        return pd.read_sql_query('''
+            SELECT * FROM sh_index
+            ORDER BY date DESC
+            LIMIT ?
+        ''', self._conn, params=[limit], parse_dates={'date': {'format': '%Y-%m-%d'}}) 
\ No newline at end of file
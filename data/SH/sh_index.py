@@ -0,0 +1,120 @@
+"""
+上证指数数据的读取与导出，回测模块 backtest.py 与 calculate_sh_returns.py 共用
+"""
+import sqlite3
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# 上证指数数据目录
+SH_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(SH_DIR, 'SH_data.db')
+PARQUET_PATH = os.path.join(SH_DIR, 'SH_data.parquet')
+
+def _file_mtime(path):
+    """返回文件修改时间，文件不存在时返回None"""
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+def _db_mtime():
+    """
+    返回数据库的修改时间，数据库不存在时返回None
+    
+    WAL模式下未检查点的写入只落在 -wal 文件中，因此取两者中较新的修改时间；
+    打开连接时新建的空 -wal 文件不含写入，不计入
+    """
+    db_mtime = _file_mtime(DB_PATH)
+    wal_path = DB_PATH + '-wal'
+    if db_mtime is not None and os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+        db_mtime = max(db_mtime, os.path.getmtime(wal_path))
+    return db_mtime
+
+def load_sh_returns(start_date, end_date):
+    """
+    读取上证指数收盘价并计算每日变化率与累计收益率
+    
+    数据文件（含数据库的 -wal 文件）的修改时间参与缓存键，同一区间与数据文件版本只读取一次，文件更新后重新读取；
+    返回的DataFrame为共享的缓存对象，调用方需要修改时应先复制
+    
+    Args:
+        start_date: 开始日期（字符串、datetime或pd.Timestamp）
+        end_date: 结束日期（字符串、datetime或pd.Timestamp）
+    
+    Returns:
+        列为日期、收盘价、日收益率(%)、累计收益率(%)的DataFrame，区间内没有数据时返回空DataFrame
+    """
+    return _load_sh(pd.Timestamp(start_date), pd.Timestamp(end_date),
+                    _db_mtime(), _file_mtime(PARQUET_PATH))
+
+@lru_cache(maxsize=8)
+def _load_sh(start_date, end_date, db_mtime, parquet_mtime):
+    """按区间与数据文件修改时间缓存的 load_sh_returns 实现"""
+    if parquet_mtime is not None and (db_mtime is None or parquet_mtime >= db_mtime):
+        # Parquet副本不旧于数据库时优先读取，只加载日期与收盘价两列
+        sh_data = pd.read_parquet(PARQUET_PATH, columns=['date', 'close'],
+                                  filters=[('date', '>=', start_date.normalize()),
+                                           ('date', '<=', end_date.normalize())])
+    else:
+        # 连接数据库
+        conn = sqlite3.connect(DB_PATH)
+    
+        # 读取数据
+        query = """
+        SELECT date, close
+        FROM sh_index
+        WHERE date BETWEEN ? AND ?
+        ORDER BY date
+        """
+        rows = conn.execute(query, [start_date.strftime('%Y-%m-%d'),
+                                    end_date.strftime('%Y-%m-%d')]).fetchall()
+    
+        # 关闭数据库连接
+        conn.close()
+    
+        # 只有两列，直接转成NumPy数组，省去pandas的类型推断
+        sh_data = pd.DataFrame({
+            'date': np.array([row[0] for row in rows], dtype='datetime64[D]').astype('datetime64[ns]'),
+            'close': np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+        })
+    
+    if sh_data.empty:
+        return sh_data
+    
+    # 直接由收盘价数组计算每日变化率与累计收益率（首日均为空值）
+    # 累计收益率直接与首日收盘价相比，不再逐日连乘累积舍入误差
+    close = sh_data['close'].to_numpy(dtype=np.float64)
+    returns = np.full((len(close), 2), np.nan)
+    returns[1:, 0] = (close[1:] / close[:-1] - 1) * 100
+    returns[1:, 1] = (close[1:] / close[0] - 1) * 100
+    sh_data[['daily_return', 'cumulative_return']] = returns
+    
+    # 重命名列
+    return sh_data.rename(columns={
+        'date': '日期',
+        'close': '收盘价',
+        'daily_return': '日收益率(%)',
+        'cumulative_return': '累计收益率(%)'
+    })
+
+def write_csv(df, path):
+    """
+    以单次缓冲写入的方式导出CSV，输出与 to_csv(index=False, encoding='utf-8-sig') 一致
+    
+    Args:
+        df: 只包含日期列与浮点数列的DataFrame
+        path: 输出文件路径
+    """
+    columns = []
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if np.issubdtype(values.dtype, np.datetime64):
+            text = np.datetime_as_string(values, unit='D')
+        else:
+            text = values.astype(np.float64).astype(str)
+            text[np.isnan(values.astype(np.float64))] = ''
+        columns.append(text.tolist())
+    lines = [','.join(df.columns)]
+    lines.extend(','.join(row) for row in zip(*columns))
+    with open(path, 'w', encoding='utf-8-sig') as f:
+        f.write('\n'.join(lines) + '\n')
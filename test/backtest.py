@@ -1,18 +1,162 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import matplotlib
+matplotlib.use('Agg')  # 只输出图片文件，不初始化图形界面后端
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib import font_manager
-import sqlite3
 import os
+import sys
+from numba_utils import njit
+
+# 上证指数数据目录，读取与导出由其中的 sh_index 模块完成
+SH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'SH')
+sys.path.append(SH_DIR)
+from sh_index import load_sh_returns, write_csv
 
 # 设置中文字体
 plt.rcParams['font.sans-serif'] = ['SimHei']  # 用来正常显示中文标签
 plt.rcParams['axes.unicode_minus'] = False  # 用来正常显示负号
 
+@njit(cache=True)
+def _simulate(close, available, rebalance_rows, selected_idx, init_cash,
+              commission_rate_buy, commission_rate_sell, min_commission, slippage):
+    """
+    回测模拟内核：逐个调仓区间推进，在调仓日执行买卖，区间内的组合价值整体计算
+    
+    Args:
+        close: (T, N) 收盘价矩阵（float32），价格、金额与组合价值均以float64计算
+        available: (T, N) 当日是否有行情
+        rebalance_rows: (R,) 调仓日所在的行号
+        selected_idx: (R, top_n) 每个调仓日选出的股票列号，不足top_n时以-1填充
+        init_cash: 初始资金
+        
+    Returns:
+        portfolio_value: (T,) 每个交易日的组合价值
+        cash: 期末现金
+        shares: (N,) 期末持仓数量
+        trades: (K, 7) 交易记录，列依次为行号、列号、操作（1买入/-1卖出/0资金不足）、价格、数量、金额、手续费
+    """
+    T, N = close.shape
+    R, top_n = selected_idx.shape
+    shares = np.zeros(N)
+    selected = np.zeros(N, dtype=np.bool_)
+    portfolio_value = np.empty(T)
+    trades = np.empty((R * (N + top_n), 7))
+    n_trades = 0
+    cash = init_cash
+    # 当前持仓的列号，只在调仓日变化
+    positions = np.empty(0, dtype=np.int64)
+    
+    # 持仓只在调仓日变化，相邻两个调仓日之间的组合价值按区间整体计算
+    seg_start = 0
+    for k in range(R + 1):
+        seg_end = rebalance_rows[k] if k < R else T
+        if seg_end > seg_start:
+            # 停牌股票已按最近一个交易日的收盘价填充
+            market_value = (close[seg_start:seg_end][:, positions] * shares[positions]).sum(axis=1)
+            portfolio_value[seg_start:seg_end] = cash + market_value
+        if k == R:
+            break
+        
+        i = seg_end
+        seg_start = i
+        selection = selected_idx[k]
+        selection = selection[selection >= 0]
+        selected[:] = False
+        selected[selection] = True
+        
+        # 持仓与选股池一致时无需调仓
+        held = shares > 0
+        if len(selection) == 0 or (held.any() and (held == selected).all()):
+            continue
+        
+        # 卖出不在选股池中的股票
+        cols = np.nonzero(held & ~selected & available[i])[0]
+        m = len(cols)
+        if m > 0:
+            sell_price = close[i][cols].astype(np.float64) * (1 - slippage)
+            position_value = shares[cols] * sell_price
+            commission = np.maximum(position_value * commission_rate_sell, min_commission)
+            actual_value = position_value - commission
+            for t in range(m):
+                cash += actual_value[t]
+            trades[n_trades:n_trades + m, 0] = i
+            trades[n_trades:n_trades + m, 1] = cols
+            trades[n_trades:n_trades + m, 2] = -1
+            trades[n_trades:n_trades + m, 3] = sell_price
+            trades[n_trades:n_trades + m, 4] = shares[cols]
+            trades[n_trades:n_trades + m, 5] = actual_value
+            trades[n_trades:n_trades + m, 6] = commission
+            n_trades += m
+            shares[cols] = 0
+        
+        # 剩余资金等额买入选股池中新增的股票
+        new_cols = selection[shares[selection] == 0]
+        if len(new_cols) > 0:
+            per_stock_value = cash / len(new_cols)
+            commission = max(per_stock_value * commission_rate_buy, min_commission)
+            actual_value = per_stock_value - commission
+            cols = new_cols[available[i][new_cols]]
+            m = len(cols)
+            buy_price = close[i][cols].astype(np.float64) * (1 + slippage)
+            # 计算可买入数量（向下取整到100股的倍数），资金不足时记为0
+            n = np.trunc(actual_value / buy_price / 100) * 100
+            bought = n > 0
+            n[~bought] = 0
+            for t in range(m):
+                if bought[t]:
+                    cash -= n[t] * buy_price[t] + commission
+            trades[n_trades:n_trades + m, 0] = i
+            trades[n_trades:n_trades + m, 1] = cols
+            trades[n_trades:n_trades + m, 2] = bought.astype(np.float64)
+            trades[n_trades:n_trades + m, 3] = buy_price
+            trades[n_trades:n_trades + m, 4] = n
+            trades[n_trades:n_trades + m, 5] = np.where(bought, n * buy_price, actual_value)
+            trades[n_trades:n_trades + m, 6] = commission
+            n_trades += m
+            shares[cols] = n
+        
+        positions = np.nonzero(shares != 0)[0]
+        
+    return portfolio_value, cash, shares, trades[:n_trades]
+
+@njit(cache=True)
+def _return_stats(returns, portfolio_value):
+    """
+    单次遍历计算收益率标准差（样本标准差）与组合价值的最大回撤
+    
+    Returns:
+        std: 日收益率标准差，少于两个数据时为NaN
+        max_drawdown: 最大回撤（非正数）
+    """
+    # Welford 算法在一次遍历中累计均值与方差
+    n = returns.shape[0]
+    mean = 0.0
+    m2 = 0.0
+    for i in range(n):
+        delta = returns[i] - mean
+        mean += delta / (i + 1)
+        m2 += delta * (returns[i] - mean)
+    std = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+    
+    running_max = -np.inf
+    max_drawdown = 0.0
+    for i in range(portfolio_value.shape[0]):
+        if portfolio_value[i] > running_max:
+            running_max = portfolio_value[i]
+        drawdown = (portfolio_value[i] - running_max) / running_max
+        if drawdown < max_drawdown:
+            max_drawdown = drawdown
+    return std, max_drawdown
+
+# 交易历史的列
+TRADE_COLUMNS = ['date', 'code', 'action', 'price', 'shares', 'value', 'commission']
+
 class Backtest:
-    def __init__(self, stock_data, start_date, end_date, factor_model=None, rebalance_period=20, top_n=3):
+    def __init__(self, stock_data, start_date, end_date, factor_model=None, rebalance_period=20, top_n=3,
+                 verbose=False):
         """
         初始化回测类
         
@@ -23,74 +167,75 @@ class Backtest:
             factor_model: 因子模型实例
             rebalance_period: 调仓周期（交易日），默认20天（约一个月）
             top_n: 每次选择的股票数量
+            verbose: 是否逐日输出组合价值、选股与交易明细
         """
         self.stock_data = stock_data
-        self.start_date = start_date
-        self.end_date = end_date
+        self.start_date = pd.Timestamp(start_date)
+        self.end_date = pd.Timestamp(end_date)
         self.factor_model = factor_model
         self.rebalance_period = rebalance_period  # 调仓周期（交易日）
         self.top_n = top_n  # 每次选择的股票数量
-        self.portfolio_value = []
+        self.verbose = verbose  # 是否输出逐日明细
+        self.portfolio_value = np.empty(0)  # 组合价值，首个元素为初始资金，其后对应每个交易日
         self.returns = []
-        self.positions = {}  # 记录持仓情况
-        self.trade_history = []  # 记录交易历史
+        self.shares = np.zeros(len(stock_data))  # 记录持仓数量，与 self.codes 对齐
+        # 交易历史按列存储，列依次为日期、股票代码、操作、价格、数量、金额、手续费
+        self.trade_history = {column: [] for column in TRADE_COLUMNS}
+        self.factor_panel = {}  # 因子原始值矩阵，行对齐交易日，列对齐 self.codes
+        self.sh_data = None  # 上证指数收益率数据，由 calculate_sh_returns 填充
         self.cash = 50000  # 初始资金
         self.commission_rate_buy = 0.0001  # 买入手续费率
         self.commission_rate_sell = 0.0003  # 卖出手续费率
         self.min_commission = 5  # 最低手续费
         self.slippage = 0.0002  # 滑点
         
+        # 构建对齐到交易日历的收盘价矩阵
+        self._build_price_matrix()
+        
         # 计算上证指数收益率
         self.calculate_sh_returns()
         
+    def _build_price_matrix(self):
+        """将各股票收盘价对齐到统一的交易日历，构建 (交易日 × 股票) 收盘价矩阵"""
+        self.codes = list(self.stock_data.keys())
+        self.code_idx = {code: j for j, code in enumerate(self.codes)}
+        
+        if not self.codes:
+            self.trading_days = pd.DatetimeIndex([])
+            self.trading_day_labels = []
+            self.close = np.empty((0, 0), dtype=np.float32)
+            self.available = np.empty((0, 0), dtype=bool)
+            return
+            
+        close_df = pd.concat({code: data['收盘'] for code, data in self.stock_data.items()}, axis=1).sort_index()
+        in_range = (close_df.index >= self.start_date) & (close_df.index <= self.end_date)
+        
+        # 交易日为所有股票行情日期的并集
+        self.trading_days = close_df.index[in_range]
+        # 交易日的文本形式只格式化一次，供日志与报告复用
+        self.trading_day_labels = self.trading_days.strftime('%Y-%m-%d').tolist()
+        # 当日有行情才可交易（停牌时不可买卖）
+        self.available = close_df.notna().to_numpy()[in_range]
+        # 无行情时沿用最近一个交易日的收盘价估值
+        # 收盘价精度用float32足够，矩阵占用与内存带宽减半
+        self.close = close_df.ffill().fillna(0.0).to_numpy(dtype=np.float32)[in_range]
+        
     def calculate_sh_returns(self):
         """计算上证指数的每日变化率并保存为CSV文件"""
         try:
-            # 获取当前脚本所在目录
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            db_path = os.path.join(current_dir, 'data', 'SH', 'SH_data.db')
-            
-            # 连接数据库
-            conn = sqlite3.connect(db_path)
-            
-            # 读取数据
-            query = """
-            SELECT date, close
-            FROM sh_index
-            WHERE date BETWEEN ? AND ?
-            ORDER BY date
-            """
-            sh_data = pd.read_sql_query(query, conn, 
-                                      params=[self.start_date.strftime('%Y-%m-%d'), 
-                                             self.end_date.strftime('%Y-%m-%d')])
-            
-            # 关闭数据库连接
-            conn.close()
+            # 数据文件的修改时间参与缓存键，文件更新后重新读取
+            sh_data = load_sh_returns(self.start_date, self.end_date)
             
             if sh_data.empty:
                 print(f"错误：在 {self.start_date} 到 {self.end_date} 期间没有找到上证指数数据")
                 return
             
-            # 转换日期格式
-            sh_data['date'] = pd.to_datetime(sh_data['date'])
-            
-            # 计算每日变化率
-            sh_data['daily_return'] = sh_data['close'].pct_change() * 100
-            
-            # 计算累计收益率
-            sh_data['cumulative_return'] = ((1 + sh_data['daily_return']/100).cumprod() - 1) * 100
-            
-            # 重命名列
-            sh_data = sh_data.rename(columns={
-                'date': '日期',
-                'close': '收盘价',
-                'daily_return': '日收益率(%)',
-                'cumulative_return': '累计收益率(%)'
-            })
+            # 缓存结果供生成报告使用，复制一份避免修改共享的缓存
+            self.sh_data = sh_data.copy()
             
             # 保存为CSV文件
-            output_file = os.path.join(current_dir, 'data', 'SH', 'sh_returns.csv')
-            sh_data.to_csv(output_file, index=False, encoding='utf-8-sig')
+            output_file = os.path.join(SH_DIR, 'sh_returns.csv')
+            write_csv(sh_data, output_file)
             
             print(f"上证指数收益率数据已保存到 {output_file}")
             print(f"数据期间：{sh_data['日期'].min().strftime('%Y-%m-%d')} 至 {sh_data['日期'].max().strftime('%Y-%m-%d')}")
@@ -107,7 +252,7 @@ class Backtest:
         """计算手续费"""
         rate = self.commission_rate_buy if is_buy else self.commission_rate_sell
         commission = value * rate
-        return max(commission, self.min_commission)
+        return np.maximum(commission, self.min_commission)
         
     def apply_slippage(self, price, is_buy=True):
         """应用滑点"""
@@ -120,204 +265,132 @@ class Backtest:
         """运行回测"""
         # 初始化投资组合
         self.cash = 50000  # 初始资金
-        portfolio_value = self.cash  # 初始资金
-        self.portfolio_value = [portfolio_value]  # 重置投资组合价值列表
+        initial_cash = self.cash
+        self.portfolio_value = np.array([initial_cash], dtype=np.float64)  # 重置投资组合价值
         
         # 检查股票数据是否为空
-        if not self.stock_data:
+        if not self.stock_data or len(self.trading_days) == 0:
             print("错误：没有股票数据可供回测")
             return
             
         print(f"开始回测，共有 {len(self.stock_data)} 只股票")
+        print(f"回测日期范围：{self.trading_days[0]} 至 {self.trading_days[-1]}，共 {len(self.trading_days)} 个交易日")
+        
+        # 先完成所有调仓日的选股，再运行数值模拟内核
+        rebalance_rows, selected_idx = self._select_stocks()
+        portfolio_values, self.cash, self.shares, trades = _simulate(
+            self.close, self.available, rebalance_rows, selected_idx, float(initial_cash),
+            self.commission_rate_buy, self.commission_rate_sell, float(self.min_commission), self.slippage
+        )
+        self._record_trades(trades)
+        
+        # 计算每日收益率，第一天收益率为0
+        daily_returns = np.zeros(len(portfolio_values))
+        prev_values = portfolio_values[:-1]
+        valid = prev_values > 0
+        daily_returns[1:][valid] = portfolio_values[1:][valid] / prev_values[valid] - 1
+        
+        if self.verbose:
+            for date, value, daily_return in zip(self.trading_day_labels, portfolio_values, daily_returns):
+                print(f"日期: {date}, 投资组合价值: {value:.2f}, 收益率: {daily_return:.2%}")
+        
+        # 一次性写入预分配的数组：首位为初始资金，其后为各交易日的组合价值
+        self.portfolio_value = np.empty(len(portfolio_values) + 1)
+        self.portfolio_value[0] = initial_cash
+        self.portfolio_value[1:] = portfolio_values
+        print(f"回测完成，共计算出 {len(daily_returns)} 个交易日的收益率，"
+              f"调仓 {len(rebalance_rows)} 次，成交 {len(self.trade_history['date'])} 笔")
+            
+        self.returns = pd.Series(daily_returns)
         
-        # 获取日期范围
-        date_range = pd.date_range(start=self.start_date, end=self.end_date)
-        print(f"回测日期范围：{date_range[0]} 至 {date_range[-1]}，共 {len(date_range)} 个交易日")
-        
-        # 初始化持仓
-        self.positions = {}  # 记录持仓数量
-        self.position_values = {}  # 记录持仓市值
-        self.returns = []  # 重置收益率列表
-        
-        # 计算每日收益率
-        for i, date in enumerate(date_range):
-            # 检查是否需要调仓
-            if i % self.rebalance_period == 0 and self.factor_model is not None:
-                # 获取当前可用的股票数据
-                available_stocks = {}
-                for code, data in self.stock_data.items():
-                    if date in data.index:
-                        # 获取到当前日期为止的所有历史数据
-                        historical_data = data[data.index <= date].copy()
-                        if not historical_data.empty:
-                            available_stocks[code] = historical_data
+    def _select_stocks(self):
+        """
+        计算每个调仓日的选股结果
+        
+        Returns:
+            rebalance_rows: 调仓日在交易日索引中的行号
+            selected_idx: 每个调仓日选出的股票列号，不足top_n时以-1填充
+        """
+        if self.factor_model is None:
+            return np.empty(0, dtype=np.int64), np.full((0, self.top_n), -1, dtype=np.int64)
+            
+        rebalance_rows = np.arange(0, len(self.trading_days), self.rebalance_period, dtype=np.int64)
+        selected_idx = np.full((len(rebalance_rows), self.top_n), -1, dtype=np.int64)
+        
+        # 因子只依赖各股票自身的历史数据，一次性算出全部交易日的因子值，调仓日直接取截面
+        self.factor_panel = {
+            factor: frame.reindex(index=self.trading_days, columns=self.codes).to_numpy(dtype=np.float64)
+            for factor, frame in self.factor_model.calculate_factor_panel(self.stock_data).items()
+        }
+        
+        for k, i in enumerate(rebalance_rows):
+            available_row = self.available[i]
+            
+            if available_row.any():
+                # 使用当日有交易的股票的因子截面打分，只需按行取值
+                self.factor_model.score_at(self.factor_panel, i, self.codes, available_row)
+                selected_stocks = self.factor_model.select_top_stocks(self.top_n)
                 
-                if available_stocks:
-                    # 使用历史数据重新计算因子
-                    self.factor_model.calculate_technical_factors(available_stocks)
-                    final_scores = self.factor_model.calculate_final_score()
-                    selected_stocks = [(code, score) for code, score in final_scores.items()]
-                    selected_stocks.sort(key=lambda x: x[1], reverse=True)
-                    selected_stocks = selected_stocks[:self.top_n]
-                    
-                    # 记录选股结果
-                    selected_codes = [code for code, _ in selected_stocks]
-                    print(f"日期 {date.strftime('%Y-%m-%d')} 选出的股票: {selected_codes}")
-                    
-                    # 计算当前总市值
-                    total_value = self.cash
-                    for code in list(self.positions.keys()):
-                        if date in self.stock_data[code].index:
-                            close_price = self.stock_data[code].loc[date, '收盘']
-                            position_value = self.positions[code] * close_price
-                            total_value += position_value
-                    
-                    # 检查持仓情况
-                    if not self.positions:  # 如果没有持仓
-                        # 买入选股池中的股票
-                        per_stock_value = total_value / len(selected_codes)
-                        for code in selected_codes:
-                            if date in self.stock_data[code].index:
-                                close_price = self.stock_data[code].loc[date, '收盘']
-                                # 应用滑点
-                                buy_price = self.apply_slippage(close_price, True)
-                                # 计算手续费
-                                commission = self.calculate_commission(per_stock_value, True)
-                                # 实际可用资金
-                                actual_value = per_stock_value - commission
-                                # 计算可买入数量（向下取整到100股的倍数）
-                                shares = int(actual_value / buy_price / 100) * 100
-                                if shares > 0:  # 只有当可以买入至少100股时才执行
-                                    self.positions[code] = shares  # 记录持仓数量
-                                    self.cash -= (shares * buy_price + commission)  # 扣除买入股票的资金和手续费
-                                    self.trade_history.append({
-                                        'date': date,
-                                        'code': code,
-                                        'action': 'buy',
-                                        'price': buy_price,
-                                        'shares': shares,
-                                        'value': shares * buy_price,
-                                        'commission': commission
-                                    })
-                                    print(f"日期 {date.strftime('%Y-%m-%d')} 建仓: {code}, 价格: {buy_price:.2f}, 数量: {shares}, 手续费: {commission:.2f}")
-                                else:
-                                    print(f"日期 {date.strftime('%Y-%m-%d')} 资金不足，无法买入 {code}，需要资金: {buy_price * 100:.2f}，可用资金: {actual_value:.2f}")
-                    else:  # 如果有持仓
-                        # 检查持仓是否和选股池一致
-                        current_holdings = set(self.positions.keys())
-                        selected_set = set(selected_codes)
-                        
-                        if current_holdings != selected_set:  # 如果不一致
-                            # 卖出不在选股池中的股票
-                            for code in list(self.positions.keys()):
-                                if code not in selected_codes:
-                                    if date in self.stock_data[code].index:
-                                        close_price = self.stock_data[code].loc[date, '收盘']
-                                        # 应用滑点
-                                        sell_price = self.apply_slippage(close_price, False)
-                                        position_value = self.positions[code] * sell_price
-                                        # 计算手续费
-                                        commission = self.calculate_commission(position_value, False)
-                                        # 实际获得资金
-                                        actual_value = position_value - commission
-                                        self.cash += actual_value
-                                        self.trade_history.append({
-                                            'date': date,
-                                            'code': code,
-                                            'action': 'sell',
-                                            'price': sell_price,
-                                            'shares': self.positions[code],
-                                            'value': actual_value,
-                                            'commission': commission
-                                        })
-                                        print(f"日期 {date.strftime('%Y-%m-%d')} 平仓: {code}, 价格: {sell_price:.2f}, 数量: {self.positions[code]}, 手续费: {commission:.2f}")
-                                        del self.positions[code]  # 删除持仓记录
-                            
-                            # 计算剩余资金
-                            remaining_value = self.cash
-                            for code, value in self.position_values.items():
-                                remaining_value += value
-                            
-                            # 买入选股池中新增的股票
-                            new_stocks = selected_set - current_holdings
-                            if new_stocks:
-                                per_stock_value = remaining_value / len(new_stocks)
-                                for code in new_stocks:
-                                    if date in self.stock_data[code].index:
-                                        close_price = self.stock_data[code].loc[date, '收盘']
-                                        # 应用滑点
-                                        buy_price = self.apply_slippage(close_price, True)
-                                        # 计算手续费
-                                        commission = self.calculate_commission(per_stock_value, True)
-                                        # 实际可用资金
-                                        actual_value = per_stock_value - commission
-                                        # 计算可买入数量（向下取整到100股的倍数）
-                                        shares = int(actual_value / buy_price / 100) * 100
-                                        if shares > 0:  # 只有当可以买入至少100股时才执行
-                                            self.positions[code] = shares  # 记录持仓数量
-                                            self.cash -= (shares * buy_price + commission)  # 扣除买入股票的资金和手续费
-                                            self.trade_history.append({
-                                                'date': date,
-                                                'code': code,
-                                                'action': 'buy',
-                                                'price': buy_price,
-                                                'shares': shares,
-                                                'value': shares * buy_price,
-                                                'commission': commission
-                                            })
-                                            print(f"日期 {date.strftime('%Y-%m-%d')} 建仓: {code}, 价格: {buy_price:.2f}, 数量: {shares}, 手续费: {commission:.2f}")
-                                        else:
-                                            print(f"日期 {date.strftime('%Y-%m-%d')} 资金不足，无法买入 {code}，需要资金: {buy_price * 100:.2f}，可用资金: {actual_value:.2f}")
-            
-            # 计算当日总市值
-            current_total_value = self.cash
-            print(f"日期: {date}, 现金: {self.cash:.2f}")
-            
-            # 根据持仓计算市值
-            for code, shares in self.positions.items():
-                if date in self.stock_data[code].index:
-                    close_price = self.stock_data[code].loc[date, '收盘']
-                    position_value = shares * close_price
-                    current_total_value += position_value
-                    print(f"股票: {code}, 持仓数量: {shares}, 价格: {close_price:.2f}, 市值: {position_value:.2f}")
-                else:
-                    # 如果是节假日，使用最近一个交易日的收盘价
-                    last_trading_day = self.stock_data[code].index[self.stock_data[code].index < date][-1]
-                    close_price = self.stock_data[code].loc[last_trading_day, '收盘']
-                    position_value = shares * close_price
-                    current_total_value += position_value
-                    print(f"股票: {code}, 持仓数量: {shares}, 价格: {close_price:.2f} (使用{last_trading_day.strftime('%Y-%m-%d')}收盘价), 市值: {position_value:.2f}")
-            print(f"当日总市值: {current_total_value:.2f}")
-            
-            # 计算收益率
-            if i > 0:  # 不是第一天
-                prev_total_value = self.portfolio_value[-1]  # 使用前一天的投资组合价值
-                print(f"昨日总市值: {prev_total_value:.2f}")
+                # 记录选股结果
+                selected_codes = [code for code, _ in selected_stocks]
+                if self.verbose:
+                    print(f"日期 {self.trading_day_labels[i]} 选出的股票: {selected_codes}")
+                selected_idx[k, :len(selected_codes)] = [self.code_idx[code] for code in selected_codes]
                 
-                if prev_total_value > 0:
-                    daily_return = (current_total_value / prev_total_value) - 1
-                    print(f"收益率: {daily_return:.2%}")
+        return rebalance_rows, selected_idx
+        
+    def _record_trades(self, trades):
+        """将模拟内核输出的交易记录按列追加到交易历史"""
+        rows = trades[:, 0].astype(np.int64)
+        cols = trades[:, 1].astype(np.int64)
+        action = trades[:, 2]
+        
+        if self.verbose:
+            for i, j, act, price, shares, value, commission in zip(rows, cols, action, trades[:, 3], 
+                                                                     trades[:, 4], trades[:, 5], trades[:, 6]):
+                label = self.trading_day_labels[i]
+                code = self.codes[j]
+                if act == 0:
+                    print(f"日期 {label} 资金不足，无法买入 {code}，需要资金: {price * 100:.2f}，可用资金: {value:.2f}")
                 else:
-                    print("警告：昨日总市值为0")
-                    daily_return = 0
-            else:  # 第一天
-                daily_return = 0
-                print("第一天，收益率为0")
-            
-            # 更新投资组合价值
-            portfolio_value = current_total_value  # 直接使用当日计算的总市值
-            
-            self.portfolio_value.append(portfolio_value)
-            self.returns.append(daily_return)
-            print(f"投资组合价值: {portfolio_value:.2f}\n")
-        
-        # 检查是否有足够的收益率数据
-        if len(self.returns) == 0:
-            print("错误：没有计算出任何收益率，请检查数据是否正确")
-        else:
-            print(f"回测完成，共计算出 {len(self.returns)} 个交易日的收益率")
+                    action_name = '建仓' if act > 0 else '平仓'
+                    print(f"日期 {label} {action_name}: {code}, 价格: {price:.2f}, 数量: {int(shares)}, 手续费: {commission:.2f}")
+        
+        # 资金不足未成交的记录不计入交易历史
+        filled = action != 0
+        history = self.trade_history
+        history['date'].extend(self.trading_days[rows[filled]])
+        history['code'].extend(np.asarray(self.codes, dtype=object)[cols[filled]].tolist())
+        history['action'].extend(np.where(action[filled] > 0, 'buy', 'sell').tolist())
+        history['price'].extend(trades[filled, 3].tolist())
+        history['shares'].extend(trades[filled, 4].astype(np.int64).tolist())
+        history['value'].extend(trades[filled, 5].tolist())
+        history['commission'].extend(trades[filled, 6].tolist())
+        
+    def _trade_profits(self):
+        """
+        按日期排序交易历史，并计算每笔卖出相对同一股票最近一次买入的盈亏
+        
+        Returns:
+            trade_df: 按日期稳定排序后的交易记录
+            profit: 与trade_df行对齐的盈亏，买入及找不到对应买入的卖出为NaN
+        """
+        trade_df = pd.DataFrame(self.trade_history)
+        if trade_df.empty:
+            return trade_df, pd.Series(dtype=np.float64)
             
-        self.returns = pd.Series(self.returns)
+        # 按日期排序（稳定排序，保持同日交易的原始顺序）
+        trade_df['date'] = pd.to_datetime(trade_df['date'], format='ISO8601', cache=True)
+        trade_df = trade_df.sort_values('date', kind='mergesort').reset_index(drop=True)
+        
+        # 卖出盈亏：匹配同一股票在卖出日之前的最近一次买入
+        sells = trade_df[trade_df['action'] == 'sell'].reset_index()
+        buys = trade_df.loc[trade_df['action'] == 'buy', ['date', 'code', 'price']]
+        matched = pd.merge_asof(sells, buys.rename(columns={'price': 'buy_price'}),
+                                on='date', by='code', allow_exact_matches=False)
+        profit = pd.Series(np.nan, index=trade_df.index)
+        profit.loc[matched['index']] = ((matched['price'] - matched['buy_price']) * matched['shares']).to_numpy()
+        return trade_df, profit
         
     def generate_report(self):
         """生成回测报告"""
@@ -328,66 +401,47 @@ class Backtest:
                 return
                 
             # 计算回测指标
-            returns_series = pd.Series(self.returns)
+            returns = np.asarray(self.returns, dtype=np.float64)
+            portfolio_values = np.asarray(self.portfolio_value, dtype=np.float64)
+            returns_std, max_drawdown = _return_stats(returns, portfolio_values)
             
             # 计算总收益率
-            total_return = (self.portfolio_value[-1] / self.portfolio_value[0]) - 1
+            total_return = (portfolio_values[-1] / portfolio_values[0]) - 1
             
             # 计算年化收益率
-            annual_return = (1 + total_return) ** (252 / len(self.returns)) - 1
+            annual_return = (1 + total_return) ** (252 / len(returns)) - 1
             
             # 计算年化波动率
-            volatility = returns_series.std() * np.sqrt(252)
+            volatility = returns_std * np.sqrt(252)
             
             # 计算夏普比率（假设无风险利率为3%）
             risk_free_rate = 0.03
             sharpe_ratio = (annual_return - risk_free_rate) / volatility if volatility != 0 else 0
             
-            # 计算最大回撤
-            portfolio_series = pd.Series(self.portfolio_value)
-            cummax = portfolio_series.cummax()
-            drawdown = (portfolio_series - cummax) / cummax
-            max_drawdown = drawdown.min() if not drawdown.empty else 0
+            # 计算每笔卖出的盈亏，胜率与交易历史表格共用
+            trade_df, profit = self._trade_profits()
             
             # 计算胜率
-            win_trades = 0
-            total_trades = 0
-            for trade in self.trade_history:
-                if trade['action'] == 'sell':
-                    total_trades += 1
-                    # 计算该笔交易的盈亏
-                    buy_trades = [t for t in self.trade_history 
-                                if t['code'] == trade['code'] 
-                                and t['action'] == 'buy' 
-                                and t['date'] < trade['date']]
-                    if buy_trades:
-                        last_buy = buy_trades[-1]
-                        profit = (trade['price'] - last_buy['price']) * trade['shares']
-                        if profit > 0:
-                            win_trades += 1
+            total_trades = int((trade_df['action'] == 'sell').sum()) if not trade_df.empty else 0
+            win_trades = int((profit > 0).sum())
             
             win_rate = win_trades / total_trades if total_trades > 0 else 0
             
-            # 获取上证指数收益率数据
-            current_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-            sh_data = pd.read_csv(os.path.join(current_dir, 'data', 'SH', 'sh_returns.csv'))
-            sh_data['日期'] = pd.to_datetime(sh_data['日期'])
+            # 获取上证指数收益率数据，直接使用初始化时已计算好的结果
+            if self.sh_data is None:
+                print("错误：没有上证指数收益率数据，无法生成报告")
+                return
+            sh_data = self.sh_data
             
             # 绘制回测结果
-            plt.figure(figsize=(12, 6))
-            
-            # 创建日期索引
-            date_index = pd.date_range(start=self.start_date, end=self.end_date)
+            # 两张图复用同一个画布，绘制完第一张后清空并调整尺寸
+            fig = plt.figure(figsize=(12, 6))
             
-            # 确保投资组合数据长度匹配
-            if len(date_index) > len(self.portfolio_value):
-                date_index = date_index[:len(self.portfolio_value)]
-            elif len(date_index) < len(self.portfolio_value):
-                self.portfolio_value = self.portfolio_value[:len(date_index)]
+            # 交易日索引，portfolio_value[0] 为初始资金，其后依次对应每个交易日
+            date_index = self.trading_days
             
             # 计算相对于初始值的百分比变化
-            initial_value = self.portfolio_value[0]
-            portfolio_percentage = [(value / initial_value - 1) * 100 for value in self.portfolio_value]
+            portfolio_percentage = (portfolio_values[1:] / portfolio_values[0] - 1) * 100
             
             # 将投资组合数据转换为DataFrame，方便后续处理
             portfolio_df = pd.DataFrame({
@@ -395,20 +449,22 @@ class Backtest:
                 '收益率': portfolio_percentage
             })
             
-            # 筛选出与上证指数日期匹配的数据
-            portfolio_df = portfolio_df[portfolio_df['日期'].isin(sh_data['日期'])]
+            # 按日期与上证指数对齐，只保留两者都有数据的交易日，并计算超额收益
+            portfolio_df = portfolio_df.merge(sh_data[['日期', '累计收益率(%)']], on='日期', how='inner')
+            portfolio_df['超额收益'] = portfolio_df['收益率'] - portfolio_df['累计收益率(%)']
             
-            # 计算超额收益
-            excess_return = portfolio_df['收益率'].values - sh_data['累计收益率(%)'].values
+            # 数据点过多时抽样绘制，曲线形状不变
+            step = max(1, len(portfolio_df) // 2000) if len(portfolio_df) > 10000 else 1
+            sh_step = max(1, len(sh_data) // 2000) if len(sh_data) > 10000 else 1
             
             # 绘制投资组合收益率
-            plt.plot(portfolio_df['日期'], portfolio_df['收益率'], label='投资组合', linewidth=2)
+            plt.plot(portfolio_df['日期'].iloc[::step], portfolio_df['收益率'].iloc[::step], label='投资组合', linewidth=2)
             
             # 绘制上证指数收益率
-            plt.plot(sh_data['日期'], sh_data['累计收益率(%)'], label='上证指数', linestyle='--', linewidth=2, color='red')
+            plt.plot(sh_data['日期'].iloc[::sh_step], sh_data['累计收益率(%)'].iloc[::sh_step], label='上证指数', linestyle='--', linewidth=2, color='red')
             
             # 绘制超额收益
-            plt.plot(portfolio_df['日期'], excess_return, label='超额收益', linestyle=':', linewidth=2, color='orange')
+            plt.plot(portfolio_df['日期'].iloc[::step], portfolio_df['超额收益'].iloc[::step], label='超额收益', linestyle=':', linewidth=2, color='orange')
             
             plt.title('投资组合与上证指数收益率对比', fontsize=12)
             plt.xlabel('日期', fontsize=10)
@@ -418,49 +474,31 @@ class Backtest:
             # 设置x轴日期格式
             plt.gcf().autofmt_xdate()  # 自动旋转日期标签
             plt.tight_layout()
-            plt.savefig('backtest_plot.png', dpi=300, bbox_inches='tight')
-            plt.close()
+            plt.savefig('backtest_plot.png', dpi=100)
+            fig.clf()
             
             # 绘制每日收益率柱状图
-            plt.figure(figsize=(15, 6))
-            
-            # 创建日期索引
-            date_index = pd.date_range(start=self.start_date, end=self.end_date)
+            fig.set_size_inches(15, 6)
             
-            # 确保投资组合数据长度匹配
-            if len(date_index) > len(self.portfolio_value):
-                date_index = date_index[:len(self.portfolio_value)]
-            elif len(date_index) < len(self.portfolio_value):
-                self.portfolio_value = self.portfolio_value[:len(date_index)]
+            # 计算每日收益率，按位置与前一个交易日的组合价值比较
+            daily_returns = portfolio_values[1:] / portfolio_values[:-1] - 1
             
-            # 计算每日收益率
-            daily_returns = []
-            for i in range(1, len(self.portfolio_value)):
-                daily_return = (self.portfolio_value[i] / self.portfolio_value[i-1]) - 1
-                daily_returns.append(daily_return)
-            
-            bars = plt.bar(date_index[1:], daily_returns)
+            # 柱状图颜色在绘制时一次性指定：收益为正红色，为负绿色
+            colors = np.where(daily_returns >= 0, 'red', 'green')
+            plt.bar(date_index, daily_returns, color=colors, edgecolor=colors)
             plt.title('每日收益率', fontsize=12)
             plt.xlabel('日期', fontsize=10)
             plt.ylabel('收益率', fontsize=10)
             plt.grid(True, axis='y')
             
-            # 设置柱状图颜色
-            for bar in bars:
-                if bar.get_height() >= 0:
-                    bar.set_color('red')
-                else:
-                    bar.set_color('green')
-            
             # 设置x轴日期格式
             plt.gcf().autofmt_xdate()  # 自动旋转日期标签
             
             plt.tight_layout()
-            plt.savefig('daily_returns.png', dpi=300, bbox_inches='tight')
-            plt.close()
+            plt.savefig('daily_returns.png', dpi=100)
+            plt.close(fig)
             
             # 生成交易历史表格
-            trade_df = pd.DataFrame(self.trade_history)
             trade_table = ""
             if not trade_df.empty:
                 trade_table = """
@@ -478,45 +516,22 @@ class Backtest:
                     </tr>
                 """
                 
-                # 按日期分组
-                trade_df['date'] = pd.to_datetime(trade_df['date'])
-                trade_df = trade_df.sort_values('date')
+                profit_text = profit.map('{:.2f}'.format).where(profit.notna(), '')
                 
-                current_date = None
-                for _, row in trade_df.iterrows():
-                    # 如果是新的日期，添加一个分隔行
-                    if current_date != row['date']:
-                        if current_date is not None:
-                            trade_table += """
-                            <tr style="background-color: #f5f5f5;">
-                                <td colspan="8"></td>
-                            </tr>
-                            """
-                        current_date = row['date']
-                    
-                    profit = ""
-                    if row['action'] == 'sell':
-                        buy_trades = trade_df[(trade_df['code'] == row['code']) & 
-                                            (trade_df['action'] == 'buy') & 
-                                            (trade_df['date'] < row['date'])]
-                        if not buy_trades.empty:
-                            last_buy = buy_trades.iloc[-1]
-                            profit = (row['price'] - last_buy['price']) * row['shares']
-                            profit = f"{profit:.2f}"
-                    
-                    trade_table += f"""
-                    <tr>
-                        <td>{row['date'].strftime('%Y-%m-%d')}</td>
-                        <td>{row['code']}</td>
-                        <td>{'买入' if row['action'] == 'buy' else '卖出'}</td>
-                        <td>{row['price']:.2f}</td>
-                        <td>{row['shares']}</td>
-                        <td>{row['value']:.2f}</td>
-                        <td>{row['commission']:.2f}</td>
-                        <td>{profit}</td>
-                    </tr>
-                    """
-                trade_table += "</table>"
+                # 新的日期前添加一个分隔行
+                new_date = trade_df['date'].ne(trade_df['date'].shift())
+                new_date.iloc[0] = False
+                separator = new_date.map({True: '<tr style="background-color: #f5f5f5;"><td colspan="8"></td></tr>\n', False: ''})
+                
+                rows = (separator + '<tr><td>' + trade_df['date'].dt.strftime('%Y-%m-%d')
+                        + '</td><td>' + trade_df['code'].astype(str)
+                        + '</td><td>' + np.where(trade_df['action'].to_numpy() == 'buy', '买入', '卖出')
+                        + '</td><td>' + trade_df['price'].map('{:.2f}'.format)
+                        + '</td><td>' + trade_df['shares'].astype(str)
+                        + '</td><td>' + trade_df['value'].map('{:.2f}'.format)
+                        + '</td><td>' + trade_df['commission'].map('{:.2f}'.format)
+                        + '</td><td>' + profit_text + '</td></tr>').tolist()
+                trade_table += "\n".join(rows) + "</table>"
             
             # 生成HTML报告
             report = f"""
@@ -16,49 +16,40 @@ def check_database_content():
     # 连接数据库
     db = FinancialDatabase('data/financial_data.db')
     
+    tables = [('资产负债表', 'balance_sheet'), ('利润表', 'income_statement'), ('现金流量表', 'cash_flow')]
+    
     try:
-        # 检查资产负债表
-        print("\n=== 资产负债表数据 ===")
-        df_bs = db.get_balance_sheet()
-        print(f"记录数量: {len(df_bs)}")
-        print("\n数据预览:")
-        print(df_bs.head())
-        print("\n数据统计信息:")
-        print(df_bs.describe())
-        
-        # 检查利润表
-        print("\n=== 利润表数据 ===")
-        df_is = db.get_income_statement()
-        print(f"记录数量: {len(df_is)}")
-        print("\n数据预览:")
-        print(df_is.head())
-        print("\n数据统计信息:")
-        print(df_is.describe())
-        
-        # 检查现金流量表
-        print("\n=== 现金流量表数据 ===")
-        df_cf = db.get_cash_flow()
-        print(f"记录数量: {len(df_cf)}")
-        print("\n数据预览:")
-        print(df_cf.head())
-        print("\n数据统计信息:")
-        print(df_cf.describe())
+        # 记录数、预览与统计信息均在SQLite中完成，不读取整表
+        counts = {}
+        for table_name, table in tables:
+            print(f"\n=== {table_name}数据 ===")
+            counts[table] = db.count(table)
+            print(f"记录数量: {counts[table]}")
+            print("\n数据预览:")
+            print(db.head(table))
+            print("\n数据统计信息:")
+            print(db.describe(table))
         
         # 检查数据完整性
         print("\n=== 数据完整性检查 ===")
-        print(f"资产负债表记录数: {len(df_bs)}")
-        print(f"利润表记录数: {len(df_is)}")
-        print(f"现金流量表记录数: {len(df_cf)}")
+        for table_name, table in tables:
+            print(f"{table_name}记录数: {counts[table]}")
         
-        # 检查是否有重复数据
+        # 检查是否有重复数据，分组统计在SQLite中完成，只读取重复的记录
         print("\n=== 重复数据检查 ===")
-        for table_name, df in [('资产负债表', df_bs), ('利润表', df_is), ('现金流量表', df_cf)]:
-            duplicates = df.duplicated(subset=['股票代码', '公告日期'], keep=False)
-            if duplicates.any():
+        for table_name, table in tables:
+            duplicates = db.find_duplicates(table, ['股票代码', '公告日期'])
+            if not duplicates.empty:
                 print(f"{table_name}中存在重复数据:")
-                print(df[duplicates].sort_values(['股票代码', '公告日期']))
+                print(duplicates)
             else:
                 print(f"{table_name}中没有重复数据")
+            
+            # 迁移为主键表后不会再出现重复，迁移时移出的重复或缺失主键的记录单独列出
+            dropped = db.dropped_rows(table)
+            if not dropped.empty:
+                print(f"{table_name}迁移时移出了 {len(dropped)} 条重复或缺少主键的记录（保存在 {table}_dropped 表中）:")
+                print(dropped)
         
     except Exception as e:
         print(f"检查数据库时出错: {str(e)}")
@@ -1,9 +1,11 @@
 import akshare as ak
 import pandas as pd
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import tqdm
 import sys
 import os
+import logging
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database import StockDatabase
@@ -19,59 +21,75 @@ class StockDataLoader:
             # 尝试从数据库获取
             self.stock_list = self.db.get_stock_list()
             if not self.stock_list.empty:
-                print("从数据库获取股票列表")
+                logging.info("从数据库获取股票列表")
                 return self.stock_list
                 
-        print("从网络获取股票列表")
+        logging.info("从网络获取股票列表")
         # 从akshare获取数据
         self.stock_list = ak.index_stock_cons_csindex(symbol="000300")
-        print("原始列名:", self.stock_list.columns.tolist())
+        logging.debug(f"原始列名: {self.stock_list.columns.tolist()}")
         
         # 重命名列名以保持一致性
         self.stock_list = self.stock_list.rename(columns={
             '成分券代码': 'code', 
             '成分券名称': 'name'
         })
-        print("重命名后的列名:", self.stock_list.columns.tolist())
+        logging.debug(f"重命名后的列名: {self.stock_list.columns.tolist()}")
         
         # 保存到数据库
         self.db.save_stock_list(self.stock_list)
         
         return self.stock_list
     
-    def get_stock_data(self, start_date, end_date, factors=None, force_update=False):
-        """获取股票数据"""
+    def _fetch_stock_data(self, code, start_date, end_date):
+        """从网络获取单只股票的数据"""
+        return ak.stock_zh_a_hist(symbol=code, period="daily", 
+                                  start_date=start_date, end_date=end_date,
+                                  adjust="qfq")
+    
+    def get_stock_data(self, start_date, end_date, factors=None, force_update=False, max_workers=16,
+                       start_dates=None):
+        """
+        获取股票数据
+        
+        Args:
+            start_dates: 股票代码 -> 该股票的起始日期，给定时只下载这些股票，
+                         为None时按start_date下载股票列表中的所有股票
+        """
         if factors is None:
             factors = ['日期', '开盘', '收盘', '最高', '最低', '成交量', '成交额']
             
-        if self.stock_list is None:
-            self.get_stock_list()
+        if start_dates is None:
+            if self.stock_list is None:
+                self.get_stock_list()
+            start_dates = dict.fromkeys(self.stock_list['code'], start_date)
             
-        stock_data = {}
+        fetched = {}
+        empty_codes = []
         
-        # 检查每只股票的数据情况
-        for code in tqdm.tqdm(self.stock_list['code']):
-            try:
-                print(f"\n处理股票 {code}...")
-                
-                # 从网络获取数据
-                print(f"从网络获取股票 {code} 的数据，日期范围：{start_date} 到 {end_date}")
-                df = ak.stock_zh_a_hist(symbol=code, period="daily", 
-                                      start_date=start_date, end_date=end_date,
-                                      adjust="qfq")
-                
-                if df is not None and not df.empty:
-                    print(f"获取到 {len(df)} 条数据")
-                    # 只保留需要的因子
-                    df = df[factors]
-                    stock_data[code] = df
+        # 网络请求为IO密集型，使用线程池并发下载；全部下载完成后一次性写库
+        logging.info(f"从网络获取 {len(start_dates)} 只股票的数据，日期范围：{start_date} 到 {end_date}")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self._fetch_stock_data, code, code_start, end_date): code
+                       for code, code_start in start_dates.items()}
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                code = futures[future]
+                try:
+                    df = future.result()
                     
-                    # 保存到数据库
-                    self.db.save_stock_data(code, df)
-                else:
-                    print(f"股票 {code} 没有获取到数据")
+                    if df is not None and not df.empty:
+                        # 只保留需要的因子
+                        fetched[code] = df[factors]
+                    else:
+                        empty_codes.append(code)
+                        
+                except Exception as e:
+                    logging.warning(f"获取股票 {code} 数据失败: {str(e)}")
                     
-            except Exception as e:
-                print(f"获取股票 {code} 数据失败: {str(e)}")
-                
-        return stock_data 
\ No newline at end of file
+        if empty_codes:
+            logging.warning(f"{len(empty_codes)} 只股票没有获取到数据: {empty_codes}")
+                    
+        # 按股票列表的顺序返回，并在同一个事务中保存到数据库
+        stock_data = {code: fetched[code] for code in start_dates if code in fetched}
+        self.db.save_stock_data_bulk(stock_data)
+        return stock_data
@@ -15,26 +15,32 @@ class DataProcessor:
         self.financial_db = FinancialDatabase('data/financial_data.db')
         self.stock_data = {}
         self.market_data = {}
-        self.financial_data = {}
+        self.financial_data = pd.DataFrame()
         
     def filter_stocks(self, stock_list: pd.DataFrame) -> pd.DataFrame:
         """筛选股票，剔除ST股票和创业板股票"""
-        # 剔除创业板股票（代码以30开头）
-        filtered_stocks = stock_list[~stock_list['code'].str.startswith('30')]
+        # 剔除创业板股票（代码以30开头），6位数字代码转为数值后整除10000即得前两位
+        codes = stock_list['code']
+        code = pd.to_numeric(codes, errors='coerce').to_numpy(dtype=np.float64)
+        mask = code // 10000 != 30
+        # 不是6位数字的代码（位数不足、丢失前导零或含非数字字符）仍按字符串前缀判断
+        regular = ((codes.str.len() == 6) & codes.str.isdigit()).to_numpy(dtype=bool) & ~np.isnan(code)
+        irregular = ~regular
+        if irregular.any():
+            mask[irregular] = ~codes[irregular].str.startswith('30').to_numpy(dtype=bool)
         
-        # 剔除ST股票（名字中包含ST）
-        filtered_stocks = filtered_stocks[~filtered_stocks['name'].str.contains('ST', case=False)]
+        # 剔除ST股票（名字中包含ST），忽略大小写按普通子串查找，不编译正则
+        mask &= ~stock_list['name'].str.contains('ST', case=False, regex=False).to_numpy(dtype=bool)
         
-        return filtered_stocks
+        # 合并为一个布尔掩码后只筛选一次
+        return stock_list[mask]
         
     def get_stock_data(self, codes: List[str], start_date: str, end_date: str) -> Dict[str, pd.DataFrame]:
         """从历史行情数据库获取股票数据"""
-        stock_data = {}
-        for code in codes:
-            data = self.stock_db.get_stock_data(code, start_date, end_date)
-            if data is not None and not data.empty:
-                stock_data[code] = data
-        return stock_data
+        # 一次 IN 查询取出所有股票的数据，再按股票代码拆分
+        data = self.stock_db.get_all_stock_data(start_date, end_date, codes=codes)
+        return {code: group.drop(columns='code').set_index('date')
+                for code, group in data.groupby('code', sort=False, observed=True)}
         
     def get_market_data(self, start_date: str, end_date: str) -> Dict[str, pd.DataFrame]:
         """从历史行情数据库获取市场数据（使用上证指数作为市场基准）"""
@@ -45,12 +51,19 @@ class DataProcessor:
             market_data[market_code] = data
         return market_data
         
-    def get_financial_data(self, codes: List[str], date: str) -> Dict[str, pd.DataFrame]:
-        """从财务数据库获取财务数据"""
-        financial_data = {}
+    def get_financial_data(self, codes: List[str], date: str) -> pd.DataFrame:
+        """
+        从财务数据库获取财务数据
+        
+        Returns:
+            所有股票的财务数据，行索引第一层为股票代码，可用 .xs(code) 取出单只股票；
+            没有数据时返回空DataFrame
+        """
+        # 先收集各股票合并后的财务数据，循环结束后统一拼接一次
+        frames, keys = [], []
         for code in codes:
             try:
-                logging.info(f"开始获取股票 {code} 的财务数据")
+                logging.debug(f"开始获取股票 {code} 的财务数据")
                 
                 # 获取资产负债表
                 balance_sheet = self.financial_db.get_balance_sheet(code, date)
@@ -72,12 +85,13 @@ class DataProcessor:
                 
                 # 合并财务数据
                 try:
-                    financial_data[code] = pd.concat([
+                    frames.append(pd.concat([
                         balance_sheet,
                         income_statement,
                         cash_flow
-                    ], axis=1)
-                    logging.info(f"成功合并股票 {code} 的财务数据")
+                    ], axis=1))
+                    keys.append(code)
+                    logging.debug(f"成功合并股票 {code} 的财务数据")
                 except Exception as e:
                     logging.error(f"合并股票 {code} 的财务数据时出错: {str(e)}")
                     continue
@@ -86,12 +100,15 @@ class DataProcessor:
                 logging.error(f"获取股票 {code} 的财务数据时出错: {str(e)}")
                 continue
                 
-        if not financial_data:
+        if not frames:
             logging.warning(f"未找到任何股票的财务数据")
-            
-        return financial_data
+            return pd.DataFrame()
+        
+        # 逐只股票的日志只在DEBUG级别输出，循环结束后汇总一条
+        logging.info(f"成功获取 {len(keys)}/{len(codes)} 只股票的财务数据")
+        return pd.concat(frames, keys=keys, names=['code'])
         
-    def process_data(self, start_date: str, end_date: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]:
+    def process_data(self, start_date: str, end_date: str) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], pd.DataFrame]:
         """处理所有数据"""
         try:
             # 获取股票列表
@@ -116,9 +133,9 @@ class DataProcessor:
             
         except Exception as e:
             print(f"数据处理出错: {str(e)}")
-            return {}, {}, {}
+            return {}, {}, pd.DataFrame()
             
-    def get_processed_data(self) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], Dict[str, pd.DataFrame]]:
+    def get_processed_data(self) -> Tuple[Dict[str, pd.DataFrame], Dict[str, pd.DataFrame], pd.DataFrame]:
         """获取处理后的数据"""
         return self.stock_data, self.market_data, self.financial_data
         
@@ -3,17 +3,118 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import os
+import logging
+from contextlib import contextmanager
+
+# stock_data表中日期以该格式对应的整数存储（如20240131），查询参数在方法内统一转换
+DATE_FORMAT = '%Y%m%d'
+
+# stock_data表结构，{table}为表名，迁移旧表时复用
+STOCK_DATA_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    code TEXT,
+    date INTEGER,
+    开盘 REAL,
+    收盘 REAL,
+    最高 REAL,
+    最低 REAL,
+    成交量 REAL,
+    成交额 REAL,
+    update_time TIMESTAMP,
+    PRIMARY KEY (code, date)
+)
+'''
+
+# 高频调用的SQL语句，文本固定不变，可直接命中 sqlite3 的预编译语句缓存
+_SQL_INSERT_STOCK_ROWS = '''
+INSERT OR IGNORE INTO stock_data (code, date, 开盘, 收盘, 最高, 最低, 成交量, 成交额, update_time)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# EXISTS 在找到第一条记录后即停止扫描
+_SQL_EXISTS = 'SELECT EXISTS(SELECT 1 FROM stock_data WHERE code = ? AND date BETWEEN ? AND ?)'
+_SQL_COUNT = 'SELECT COUNT(*) FROM stock_data WHERE code = ? AND date BETWEEN ? AND ?'
+_SQL_RANGE = 'SELECT MIN(date), MAX(date), COUNT(*) FROM stock_data WHERE code = ?'
+
+# stock_data表中可供查询的行情列
+PRICE_COLUMNS = ['开盘', '收盘', '最高', '最低', '成交量', '成交额']
+
+# 调用方指定 dtype 时才降低精度的价格列；成交量、成交额数值很大，始终读取为float64
+OHLC_COLUMNS = ['开盘', '收盘', '最高', '最低']
+
+# 按股票代码批量查询时每条语句绑定的代码数，远低于旧版 SQLite 999 个参数的上限
+CODE_BATCH_SIZE = 500
+
+def _date_key(value):
+    """将日期参数（字符串、datetime或整数）转换为stock_data表中的整数日期"""
+    if value is None or isinstance(value, (int, np.integer)):
+        return value
+    return int(pd.Timestamp(value).strftime(DATE_FORMAT))
 
 class StockDatabase:
     def __init__(self, db_path='data/stock_data.db'):
         self.db_path = db_path
+        self._stock_list = None  # 股票列表缓存，save_stock_list时失效
+        self._stock_list_version = None  # 缓存股票列表时数据库的 data_version
+        self._conn = None  # 实例内复用的数据库连接
         self._init_db()
         
+    def _connect(self):
+        """返回实例内复用的数据库连接，首次调用时打开并设置连接级别的性能参数"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.executescript('''
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-65536;
+            ''')
+            self._conn = conn
+        return self._conn
+        
+    @contextmanager
+    def _transaction(self, name):
+        """
+        单次写入操作的事务，出错时只回滚本次写入
+        
+        使用保存点实现：不在事务中时释放保存点即提交，嵌套在外层事务中时由外层提交
+        """
+        conn = self._connect()
+        conn.execute(f'SAVEPOINT {name}')
+        try:
+            yield conn
+        except Exception:
+            conn.execute(f'ROLLBACK TO {name}')
+            raise
+        finally:
+            conn.execute(f'RELEASE {name}')
+        
+    def close(self):
+        """关闭数据库连接"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            
+    def file_version(self):
+        """
+        返回数据库文件的版本标识，用作磁盘缓存键，数据库被写入后随之变化
+        
+        WAL模式下未检查点的写入只落在 -wal 文件中，因此同时取其修改时间；
+        打开连接时新建的空 -wal 文件不含写入，不计入版本
+        """
+        wal_path = self.db_path + '-wal'
+        wal_mtime = None
+        if os.path.exists(wal_path) and os.path.getsize(wal_path) > 0:
+            wal_mtime = os.path.getmtime(wal_path)
+        return os.path.getmtime(self.db_path), wal_mtime
+        
     def _init_db(self):
         """初始化数据库，创建必要的表"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        # WAL模式写入数据库文件，只需设置一次
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # 创建股票列表表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stock_list (
@@ -23,128 +124,175 @@ class StockDatabase:
         )
         ''')
         
-        # 创建股票数据表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS stock_data (
-            code TEXT,
-            date DATE,
-            开盘 REAL,
-            收盘 REAL,
-            最高 REAL,
-            最低 REAL,
-            成交量 REAL,
-            成交额 REAL,
-            update_time TIMESTAMP,
-            PRIMARY KEY (code, date)
-        )
-        ''')
+        # 创建股票数据表，日期存为整数 yyyymmdd，比较与索引都比文本更省
+        cursor.execute(STOCK_DATA_SCHEMA.format(table='stock_data'))
         
         conn.commit()
-        conn.close()
+        self._migrate_integer_dates()
+        
+    def _migrate_integer_dates(self):
+        """将旧版以文本存储日期的stock_data表重建为整数日期"""
+        conn = self._connect()
+        columns = {row[1]: row[2] for row in conn.execute('PRAGMA table_info(stock_data)')}
+        if columns.get('date', '').upper() == 'INTEGER':
+            return
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS stock_data_new')
+            conn.execute(STOCK_DATA_SCHEMA.format(table='stock_data_new'))
+            conn.execute('''
+            INSERT OR REPLACE INTO stock_data_new (code, date, 开盘, 收盘, 最高, 最低, 成交量, 成交额, update_time)
+            SELECT code, CAST(strftime('%Y%m%d', date) AS INTEGER), 开盘, 收盘, 最高, 最低, 成交量, 成交额, update_time
+            FROM stock_data
+            ''')
+            conn.execute('DROP TABLE stock_data')
+            conn.execute('ALTER TABLE stock_data_new RENAME TO stock_data')
         
     def save_stock_list(self, stock_list):
         """保存股票列表"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 清空现有数据
-        cursor.execute('DELETE FROM stock_list')
-        
-        # 插入新数据
         current_time = datetime.now()
-        for _, row in stock_list.iterrows():
-            cursor.execute('''
-            INSERT OR REPLACE INTO stock_list (code, name, update_time)
-            VALUES (?, ?, ?)
-            ''', (row['code'], row['name'], current_time))
-            
-        conn.commit()
-        conn.close()
+        records = list(zip(stock_list['code'].tolist(),
+                           stock_list['name'].tolist(),
+                           [current_time] * len(stock_list)))
+        
+        try:
+            # 清空与插入在同一事务中完成
+            with self._transaction('save_stock_list') as conn:
+                conn.execute('DELETE FROM stock_list')
+                conn.executemany('''
+                INSERT OR REPLACE INTO stock_list (code, name, update_time)
+                VALUES (?, ?, ?)
+                ''', records)
+        finally:
+            self._stock_list = None
         
     def get_stock_list(self):
-        """获取股票列表"""
-        conn = sqlite3.connect(self.db_path)
+        """获取股票列表，数据库未被其他连接修改时直接返回缓存"""
+        conn = self._connect()
+        # 其他连接（包括其他进程）提交写入后 data_version 才会变化，检查代价远低于重新查询
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._stock_list is not None and version == self._stock_list_version:
+            return self._stock_list.copy()
+            
         cursor = conn.cursor()
         
         cursor.execute('SELECT code, name FROM stock_list')
         rows = cursor.fetchall()
-        conn.close()
         
         if not rows:
             return pd.DataFrame(columns=['code', 'name'])
             
-        return pd.DataFrame(rows, columns=['code', 'name'])
+        self._stock_list = pd.DataFrame(rows, columns=['code', 'name'])
+        self._stock_list_version = version
+        return self._stock_list.copy()
         
-    def save_stock_data(self, code, data):
-        """保存单只股票的数据"""
-        conn = sqlite3.connect(self.db_path)
-        current_time = datetime.now()
+    def _stock_records(self, code, data, current_time):
+        """将单只股票的行情数据直接转换为stock_data表的参数元组，不复制原DataFrame"""
+        # 日期列兼容中文列名，缺少日期列时使用索引
+        if '日期' in data.columns:
+            dates = data['日期']
+        elif 'date' in data.columns:
+            dates = data['date']
+        else:
+            logging.warning("数据中缺少列 'date'，将使用默认值")
+            dates = data.index
         
-        # 将数据转换为适合插入的格式
-        data = data.copy()
+        # 行情日期均为ISO格式，指定格式避免逐个推断；再按年月日直接算出整数 yyyymmdd
+        dates = pd.DatetimeIndex(pd.to_datetime(dates, format='ISO8601', cache=True))
+        date_keys = (dates.year * 10000 + dates.month * 100 + dates.day).tolist()
         
-        # 确保数据有正确的列名
-        if '日期' in data.columns:
-            data = data.rename(columns={'日期': 'date'})
-        
-        # 添加必要的列
-        data['code'] = code
-        data['update_time'] = current_time
-        
-        # 确保所有必要的列都存在
-        required_columns = ['date', '开盘', '收盘', '最高', '最低', '成交量', '成交额', 'code', 'update_time']
-        for col in required_columns:
-            if col not in data.columns:
-                print(f"警告: 数据中缺少列 '{col}'，将使用默认值")
-                if col == 'date':
-                    data[col] = data.index
-                else:
-                    data[col] = 0
+        # 确保所有行情列都存在
+        values = []
+        for col in PRICE_COLUMNS:
+            if col in data.columns:
+                values.append(data[col].tolist())
+            else:
+                logging.warning(f"数据中缺少列 '{col}'，将使用默认值")
+                values.append([0] * len(data))
+        
+        n = len(date_keys)
+        return list(zip([code] * n, date_keys, *values, [str(current_time)] * n))
         
+    def save_stock_data(self, code, data):
+        """保存单只股票的数据，批量写入期间不单独提交"""
         try:
+            records = self._stock_records(code, data, datetime.now())
+            
             # 使用事务来确保数据完整性
-            cursor = conn.cursor()
-            
-            # 获取数据库中该股票的最新日期
-            cursor.execute('SELECT MAX(date) FROM stock_data WHERE code = ?', (code,))
-            last_date = cursor.fetchone()[0]
-            
-            # 确保日期列是日期时间类型
-            data['date'] = pd.to_datetime(data['date'])
-            
-            if last_date:
-                # 如果数据库中有数据，只插入新数据
-                last_date = pd.to_datetime(last_date)
-                new_data = data[data['date'] > last_date]
-                if not new_data.empty:
-                    new_data.to_sql('stock_data', conn, if_exists='append', index=False)
-                    print(f"成功更新股票 {code} 的数据，新增 {len(new_data)} 条记录")
-                else:
-                    print(f"股票 {code} 没有新数据需要更新")
+            with self._transaction('save_stock_data') as conn:
+                # 库中已有的 (code, date) 由主键在插入时直接忽略，只写入新数据
+                inserted = self._insert_stock_rows(conn.cursor(), records)
+            if inserted:
+                logging.debug(f"成功保存股票 {code} 的数据，新增 {inserted} 条记录")
             else:
-                # 如果数据库中没有数据，插入所有数据
-                data.to_sql('stock_data', conn, if_exists='append', index=False)
-                print(f"成功保存股票 {code} 的数据，共 {len(data)} 条记录")
+                logging.debug(f"股票 {code} 没有新数据需要更新")
+            
+        except Exception as e:
+            logging.error(f"保存股票 {code} 数据时出错: {str(e)}")
+            logging.debug(f"数据预览:\n{data.head()}")
+        
+    def save_stock_data_bulk(self, stock_data):
+        """
+        使用同一个连接与事务保存多只股票的数据，每只股票只插入库中还没有的记录
+        
+        Args:
+            stock_data: 股票数据字典，key为股票代码，value为DataFrame
+        """
+        if not stock_data:
+            return
+            
+        current_time = datetime.now()
+        
+        try:
+            with self._transaction('save_stock_data_bulk') as conn:
+                cursor = conn.cursor()
                 
-            conn.commit()
+                total = 0
+                for code, data in stock_data.items():
+                    records = self._stock_records(code, data, current_time)
+                    if records:
+                        total += self._insert_stock_rows(cursor, records)
+                    
+            logging.info(f"成功保存 {len(stock_data)} 只股票的数据，新增 {total} 条记录")
             
         except Exception as e:
-            print(f"保存股票 {code} 数据时出错: {str(e)}")
-            print("数据预览:")
-            print(data.head())
-            conn.rollback()
-        finally:
-            conn.close()
+            logging.error(f"批量保存股票数据时出错: {str(e)}")
+        
+    def _insert_stock_rows(self, cursor, records):
+        """
+        将 _stock_records 生成的参数元组批量写入stock_data表
+        
+        Returns:
+            实际新增的记录数，库中已存在的 (code, date) 不会被覆盖
+        """
+        cursor.executemany(_SQL_INSERT_STOCK_ROWS, records)
+        return cursor.rowcount
+        
+    def _select_columns(self, columns, dtype=None):
+        """校验需要读取的行情列，返回SQL列清单与类型映射：价格列为dtype（未指定时为float64），其余列为float64"""
+        columns = PRICE_COLUMNS if columns is None else list(columns)
+        unknown = [col for col in columns if col not in PRICE_COLUMNS]
+        if unknown:
+            raise ValueError(f"未知的行情列: {unknown}")
+        dtypes = {col: dtype if dtype is not None and col in OHLC_COLUMNS else np.float64
+                  for col in columns}
+        return ', '.join(columns), dtypes
         
-    def get_stock_data(self, code, start_date=None, end_date=None):
-        """获取股票数据"""
+    def get_stock_data(self, code, start_date=None, end_date=None, columns=None, dtype=None):
+        """
+        获取股票数据
+        
+        Args:
+            columns: 需要读取的行情列，为None时读取全部行情列
+            dtype: 开盘、收盘、最高、最低价的读取类型（如np.float32），为None时与其余列一样为float64
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            select_columns, dtypes = self._select_columns(columns, dtype)
+            conn = self._connect()
             
-            # 构建查询条件
-            query = 'SELECT * FROM stock_data WHERE code = ?'
+            # 构建查询条件，日期参数转换为整数后比较
+            query = f'SELECT date, {select_columns} FROM stock_data WHERE code = ?'
             params = [code]
+            start_date, end_date = _date_key(start_date), _date_key(end_date)
             
             if start_date:
                 query += ' AND date >= ?'
@@ -155,67 +303,141 @@ class StockDatabase:
                 
             query += ' ORDER BY date'
             
-            # 执行查询
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            conn.close()
+            # 直接读取为DataFrame，整数日期按固定格式解析
+            df = pd.read_sql_query(query, conn, params=params,
+                                   parse_dates={'date': {'format': DATE_FORMAT}},
+                                   index_col='date', dtype=dtypes)
             
-            if not rows:
-                print(f"警告: 股票 {code} 在数据库中没有数据")
+            if df.empty:
+                logging.warning(f"股票 {code} 在数据库中没有数据")
                 return None
-                
-            # 获取列名
-            columns = ['code', 'date', '开盘', '收盘', '最高', '最低', '成交量', '成交额', 'update_time']
-            
-            # 创建DataFrame
-            df = pd.DataFrame(rows, columns=columns)
-            # 使用更灵活的日期解析格式
-            df['date'] = pd.to_datetime(df['date'], format='mixed')
-            df.set_index('date', inplace=True)
             
-            # 删除不需要的列
-            df = df.drop(['code', 'update_time'], axis=1)
-            
-            print(f"成功从数据库获取股票 {code} 的数据，共 {len(df)} 条记录")
+            logging.debug(f"成功从数据库获取股票 {code} 的数据，共 {len(df)} 条记录")
             return df
             
         except Exception as e:
-            print(f"从数据库获取股票 {code} 数据时出错: {str(e)}")
+            logging.error(f"从数据库获取股票 {code} 数据时出错: {str(e)}")
             return None
         
-    def is_data_available(self, code, start_date, end_date):
-        """检查指定时间段的数据是否已存在"""
-        conn = sqlite3.connect(self.db_path)
+    def get_eligible_codes(self, split_date, end_date=None, min_train_days=1):
+        """
+        获取可以划分训练集与测试集的股票代码
+        
+        Args:
+            split_date: 训练集与测试集的分界日期
+            end_date: 测试集结束日期
+            min_train_days: 分界日期之前至少需要的记录数
+        
+        Returns:
+            分界日期前至少有min_train_days条记录、且分界日期后有数据的股票代码集合
+        """
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-        SELECT COUNT(*) FROM stock_data 
-        WHERE code = ? AND date BETWEEN ? AND ?
-        ''', (code, start_date, end_date))
+        query = '''
+        SELECT code FROM stock_data
+        {where}
+        GROUP BY code
+        HAVING SUM(date < ?) >= ? AND MAX(date) >= ?
+        '''
+        split_date, end_date = _date_key(split_date), _date_key(end_date)
+        params = [split_date, min_train_days, split_date]
+        if end_date:
+            query = query.format(where='WHERE date <= ?')
+            params.insert(0, end_date)
+        else:
+            query = query.format(where='')
+            
+        cursor.execute(query, params)
+        codes = {row[0] for row in cursor.fetchall()}
         
-        count = cursor.fetchone()[0]
-        conn.close()
+        return codes
         
-        return count > 0
+    def get_all_stock_data(self, start_date=None, end_date=None, codes=None, columns=None, dtype=None):
+        """
+        一次查询获取所有股票在指定时间段内的数据
         
-    def get_data_date_range(self, code):
-        """获取股票数据的日期范围"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        Args:
+            codes: 只获取这些股票的数据，为None时获取全部股票；
+                   代码较多时每 CODE_BATCH_SIZE 只一批，分多条语句查询
+            columns: 需要读取的行情列，为None时读取全部行情列
+            dtype: 开盘、收盘、最高、最低价的读取类型（如np.float32），为None时与其余列一样为float64
         
-        cursor.execute('''
-        SELECT MIN(date), MAX(date), COUNT(*) 
-        FROM stock_data 
-        WHERE code = ?
-        ''', (code,))
+        Returns:
+            包含code、date及行情列的DataFrame，按股票代码和日期排序，code为分类类型；
+            没有数据时返回空DataFrame
+        """
+        select_columns, dtypes = self._select_columns(columns, dtype)
+        # 股票代码取值有限，读取为分类类型，按代码分组时使用整数编码而非字符串哈希
+        dtypes['code'] = 'category'
+        conn = self._connect()
+        start_date, end_date = _date_key(start_date), _date_key(end_date)
+        
+        if codes is None:
+            batches = [None]
+        else:
+            # 代码排序后分批，各批结果依次拼接后仍按股票代码和日期排序
+            codes = sorted(set(codes))
+            batches = [codes[i:i + CODE_BATCH_SIZE]
+                       for i in range(0, len(codes), CODE_BATCH_SIZE)] or [[]]
         
-        result = cursor.fetchone()
-        conn.close()
+        frames = []
+        for batch in batches:
+            # 构建查询条件，只读取需要的列
+            query = f'SELECT code, date, {select_columns} FROM stock_data WHERE 1 = 1'
+            params = []
+            if batch is not None:
+                query += f' AND code IN ({", ".join("?" * len(batch))})'
+                params.extend(batch)
+            if start_date:
+                query += ' AND date >= ?'
+                params.append(start_date)
+            if end_date:
+                query += ' AND date <= ?'
+                params.append(end_date)
+                
+            query += ' ORDER BY code, date'
+            
+            frames.append(pd.read_sql_query(query, conn, params=params,
+                                            parse_dates={'date': {'format': DATE_FORMAT}},
+                                            dtype=dtypes))
+        
+        if len(frames) == 1:
+            df = frames[0]
+        else:
+            # 各批的分类类别不同，统一为全部类别后拼接，code 列保持分类类型
+            categories = pd.Index(sorted(set().union(*(frame['code'].cat.categories for frame in frames))))
+            for frame in frames:
+                frame['code'] = frame['code'].cat.set_categories(categories)
+            df = pd.concat(frames, ignore_index=True)
+            
+        logging.info(f"成功从数据库获取 {df['code'].nunique()} 只股票的数据，共 {len(df)} 条记录")
+        return df
+        
+    def is_data_available(self, code, start_date, end_date, expected_days=None):
+        """
+        检查指定时间段的数据是否已存在
+        
+        Args:
+            expected_days: 该时间段内应有的交易日数，给定时要求数据完整覆盖，
+                           否则只要存在任意一条记录即视为可用
+        """
+        conn = self._connect()
+        params = (code, _date_key(start_date), _date_key(end_date))
+        
+        if expected_days is None:
+            return bool(conn.execute(_SQL_EXISTS, params).fetchone()[0])
+        return conn.execute(_SQL_COUNT, params).fetchone()[0] >= expected_days
+        
+    def get_data_date_range(self, code):
+        """获取股票数据的日期范围"""
+        conn = self._connect()
+        result = conn.execute(_SQL_RANGE, (code,)).fetchone()
         
         if result and result[0] and result[1]:
             return {
-                'start_date': result[0],
-                'end_date': result[1],
+                'start_date': pd.to_datetime(str(result[0]), format=DATE_FORMAT),
+                'end_date': pd.to_datetime(str(result[1]), format=DATE_FORMAT),
                 'count': result[2]
             }
         return None 
\ No newline at end of file
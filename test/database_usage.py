@@ -9,6 +9,7 @@ from database import StockDatabase
 from data_loader import StockDataLoader
 import pandas as pd
 from datetime import datetime, timedelta
+import logging
 
 def check_database():
     """检查数据库内容"""
@@ -41,35 +42,37 @@ def update_all_stocks(db, loader, stock_list, start_date, end_date):
     print(f"\n开始更新 {len(stock_list)} 只股票的数据...")
     print(f"更新日期范围：{start_date} 到 {end_date}")
     
-    for _, row in stock_list.iterrows():
-        code = row['code']
-        try:
-            # 获取数据库中该股票的最新日期
-            data = db.get_stock_data(code)
-            if data is not None and not data.empty:
-                last_date = data.index[-1]
-                # 如果数据库中已有最新数据，则不需要更新
-                if last_date >= pd.to_datetime(end_date):
-                    print(f"股票 {code} 的数据已是最新，无需更新")
-                    continue
-                
-                # 只获取数据库中不存在的最新数据
-                start_date = (last_date + timedelta(days=1)).strftime('%Y%m%d')
-                print(f"股票 {code} 将从 {start_date} 开始更新")
-            
-            # 获取新数据
-            print(f"获取股票 {code} 的数据...")
-            df = loader.get_stock_data(start_date=start_date, end_date=end_date)
-            if code in df and not df[code].empty:
-                # 保存新数据
-                db.save_stock_data(code, df[code])
-                print(f"成功更新股票 {code} 的数据，新增 {len(df[code])} 条记录")
-            else:
-                print(f"股票 {code} 没有新数据需要更新")
-        except Exception as e:
-            print(f"更新股票 {code} 数据时出错: {str(e)}")
+    # 先确定每只股票各自的起始日期，不修改传入的start_date
+    start_dates = {}
+    for code in stock_list['code']:
+        # 只查询数据库中该股票的最新日期，不读取全部数据
+        date_range = db.get_data_date_range(code)
+        if date_range is None:
+            start_dates[code] = start_date
+            continue
+        
+        last_date = date_range['end_date']
+        # 如果数据库中已有最新数据，则不需要更新
+        if last_date >= pd.to_datetime(end_date):
+            logging.debug(f"股票 {code} 的数据已是最新，无需更新")
+            continue
+        
+        # 只获取数据库中不存在的最新数据
+        start_dates[code] = (last_date + timedelta(days=1)).strftime('%Y%m%d')
+        logging.debug(f"股票 {code} 将从 {start_dates[code]} 开始更新")
+    
+    if not start_dates:
+        print("所有股票的数据已是最新，无需更新")
+        return
+    
+    # 一次并发下载所有需要更新的股票，加载器会在同一个事务中写入数据库
+    stock_data = loader.get_stock_data(start_date=start_date, end_date=end_date, start_dates=start_dates)
+    print(f"成功更新 {len(stock_data)} 只股票的数据")
 
 def main():
+    # 逐只股票的调试信息默认不输出，只显示汇总与错误
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    
     # 创建数据库实例
     db = StockDatabase()
     
@@ -4,13 +4,93 @@ from sklearn.preprocessing import StandardScaler
 from scipy import stats
 from typing import Dict, List, Tuple
 from financial_database import FinancialDatabase
+from numba_utils import njit, prange
 import logging
 import os
 
+@njit(cache=True)
+def _rsi_wilder_series(close, lo, hi, period, out):
+    """
+    对单只股票的收盘价 close[lo:hi] 执行Wilder平滑递推，两个批量内核共用
+    
+    Args:
+        close: 多只股票首尾相接的收盘价序列
+        lo: 该股票在close中的起始位置
+        hi: 该股票在close中的结束位置（不含）
+        period: RSI周期
+        out: 写入每日RSI的数组，与close等长；传入空数组时只计算最后一日
+    
+    Returns:
+        最后一个交易日的RSI，数据不足period+1天时为NaN
+    """
+    write_all = out.shape[0] > 0
+    rsi = np.nan
+    avg_gain = 0.0
+    avg_loss = 0.0
+    for i in range(lo + 1, hi):
+        d = close[i] - close[i - 1]
+        gain = d if d > 0 else 0.0
+        loss = -d if d < 0 else 0.0
+        if i - lo <= period:
+            # 前period个变动取简单平均作为初始值
+            avg_gain += gain / period
+            avg_loss += loss / period
+            if i - lo < period:
+                continue
+        else:
+            avg_gain = (avg_gain * (period - 1) + gain) / period
+            avg_loss = (avg_loss * (period - 1) + loss) / period
+        if not write_all and i < hi - 1:
+            continue
+        if avg_loss > 0:
+            rsi = 100 - 100 / (1 + avg_gain / avg_loss)
+        elif avg_gain > 0:
+            rsi = 100.0
+        else:
+            rsi = np.nan
+        if write_all:
+            out[i] = rsi
+    return rsi
+
+@njit(cache=True)
+def _rsi_wilder(close, starts, period):
+    """
+    使用Wilder平滑计算RSI，单次遍历价格序列
+    
+    Args:
+        close: 多只股票首尾相接的收盘价序列
+        starts: 每只股票在close中的起始位置，末尾为len(close)
+        period: RSI周期
+    """
+    out = np.full(close.shape[0], np.nan)
+    for g in range(starts.shape[0] - 1):
+        _rsi_wilder_series(close, starts[g], starts[g + 1], period, out)
+    return out
+
+@njit(parallel=True, cache=True)
+def _rsi_wilder_last(close, starts, period):
+    """
+    只计算每只股票最后一个交易日的Wilder RSI，各股票并行计算，不分配中间数组
+    
+    Args:
+        close: 多只股票首尾相接的收盘价序列
+        starts: 每只股票在close中的起始位置，末尾为len(close)
+        period: RSI周期
+    
+    Returns:
+        每只股票最后一个交易日的RSI，数据不足period+1天时为NaN
+    """
+    n = starts.shape[0] - 1
+    out = np.full(n, np.nan)
+    no_out = np.empty(0)
+    for g in prange(n):
+        out[g] = _rsi_wilder_series(close, starts[g], starts[g + 1], period, no_out)
+    return out
+
 class FactorModel:
     def __init__(self):
         self.factors = {}  # 存储因子及其权重
-        self.factor_scores = {}  # 存储每个因子的得分
+        self.factor_scores_df = None  # 存储每个因子的得分（行为股票代码，列为因子）
         self.final_scores = None  # 存储最终的综合得分
         self.scaler = StandardScaler()
         
@@ -34,13 +114,11 @@ class FactorModel:
             if not isinstance(data, pd.DataFrame) or '收盘' not in data.columns:
                 return 0.0
                 
-            close_prices = data['收盘'].astype(float)
-            delta = close_prices.diff()
-            gain = (delta.where(delta > 0, 0)).rolling(window=period).mean()
-            loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
-            rs = gain / loss
-            rsi = 100 - (100 / (1 + rs))
-            return float(rsi.iloc[-1]) if not rsi.empty else 0.0
+            close_prices = data['收盘'].to_numpy(dtype=np.float64)
+            if len(close_prices) == 0:
+                return 0.0
+            # 单只股票直接调用串行递推，不启动并行线程池
+            return float(_rsi_wilder_series(close_prices, 0, len(close_prices), period, np.empty(0)))
         except Exception as e:
             return 0.0
         
@@ -69,92 +147,209 @@ class FactorModel:
         except Exception as e:
             return 0.0
         
+    def _stack_close(self, stock_data: Dict[str, pd.DataFrame]) -> pd.Series:
+        """将各股票收盘价拼接为以(股票代码, 日期)为索引的长表"""
+        closes = {code: data['收盘'] for code, data in stock_data.items() if '收盘' in data.columns}
+        if not closes:
+            return pd.Series(dtype=float)
+        return pd.concat(closes, names=['code', 'date']).astype(float)
+        
+    def _factor_series(self, stock_data: Dict[str, pd.DataFrame]) -> Dict[str, pd.Series]:
+        """按股票分组，一次性计算所有股票每个交易日的技术因子值"""
+        close = self._stack_close(stock_data)
+        series = {}
+        if close.empty:
+            return series
+        grouped = close.groupby(level='code', sort=False)
+        
+        # 计算RSI（使用14天周期）
+        if 'rsi' in self.factors:
+            starts = np.concatenate(([0], np.cumsum(grouped.size().to_numpy())))
+            series['rsi'] = pd.Series(_rsi_wilder(close.to_numpy(), starts, 14), index=close.index)
+        
+        # 计算波动率（使用20天周期）
+        if 'volatility' in self.factors:
+            returns = close / grouped.shift(1) - 1
+            series['volatility'] = returns.groupby(level='code', sort=False).rolling(window=20).std().droplevel(0)
+        
+        # 计算动量（使用20天周期）
+        if 'momentum' in self.factors:
+            series['momentum'] = close / grouped.shift(20) - 1
+            
+        return series
+        
+    def calculate_factor_panel(self, stock_data: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+        """计算所有股票在每个交易日的技术因子原始值，返回以日期为行、股票代码为列的宽表"""
+        valid_data = {code: data for code, data in stock_data.items() 
+                      if isinstance(data, pd.DataFrame) and not data.empty}
+        return {factor: values.unstack(level='code') 
+                for factor, values in self._factor_series(valid_data).items()}
+        
+    def _assemble_close_matrix(self, stock_data: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+        """将各股票收盘价对齐为以日期为行、股票代码为列的宽表，缺少收盘价的股票整列为NaN"""
+        codes = list(stock_data.keys())
+        closes = {code: data['收盘'] for code, data in stock_data.items() if '收盘' in data.columns}
+        if not closes:
+            return pd.DataFrame(columns=codes, dtype=float)
+        return pd.concat(closes, axis=1).sort_index().reindex(columns=codes).astype(float)
+        
     def calculate_technical_factors(self, stock_data: Dict[str, pd.DataFrame], date: str = None):
         """计算所有技术因子"""
-        try:
-            self.factor_scores = {}
-            
-            # 首先计算所有股票的每个因子
-            for code, data in stock_data.items():
-                if not isinstance(data, pd.DataFrame) or data.empty:
-                    continue
-                    
-                self.factor_scores[code] = {}
-                
-                # 计算RSI（使用14天周期）
-                if 'rsi' in self.factors:
-                    self.factor_scores[code]['rsi'] = self.calculate_rsi(data, period=14)
-                
-                # 计算波动率（使用20天周期）
-                if 'volatility' in self.factors:
-                    self.factor_scores[code]['volatility'] = self.calculate_volatility(data, period=20)
-                
-                # 计算动量（使用20天周期）
-                if 'momentum' in self.factors:
-                    self.factor_scores[code]['momentum'] = self.calculate_momentum(data, period=20)
+        valid_data = {code: data for code, data in stock_data.items() 
+                      if isinstance(data, pd.DataFrame) and not data.empty}
+        
+        # 收盘价宽表转为 (股票数, 交易日数, 1) 的数组，所有股票一次计算最后一个交易日的因子值
+        closes = self._assemble_close_matrix(valid_data)
+        tensor = closes.to_numpy(dtype=np.float64).T[:, :, np.newaxis]
+        self.calculate_technical_factors_tensor(list(closes.columns), closes.index, tensor, ['收盘'])
+        
+    def build_factor_tensor(self, data: pd.DataFrame, codes: List[str], 
+                            fields: List[str]) -> Tuple[List[str], pd.DatetimeIndex, np.ndarray]:
+        """
+        将长表行情数据堆叠为 (股票数, 交易日数, 字段数) 的三维数组
+        
+        Args:
+            data: 包含code、date及行情列的长表
+            codes: 股票代码，决定数组第一维的顺序
+            fields: 需要堆叠的行情列
+        
+        Returns:
+            codes: 股票代码列表
+            dates: 所有股票交易日的并集（升序）
+            tensor: float32数组，股票在某日没有数据时为NaN
+        """
+        codes = list(codes)
+        data = data[data['code'].isin(codes)]
+        dates = pd.DatetimeIndex(np.unique(data['date'].to_numpy()))
+        if isinstance(data['code'].dtype, pd.CategoricalDtype):
+            # 分类类型的代码列只需对各类别查找位置，再按整数编码展开
+            category_rows = pd.Index(codes).get_indexer(data['code'].cat.categories)
+            rows = category_rows[data['code'].cat.codes.to_numpy()]
+        else:
+            rows = pd.Index(codes).get_indexer(data['code'])
+        cols = dates.get_indexer(data['date'])
+        
+        tensor = np.full((len(codes), len(dates), len(fields)), np.nan, dtype=np.float32)
+        tensor[rows, cols] = data[fields].to_numpy(dtype=np.float32)
+        return codes, dates, tensor
+        
+    def calculate_technical_factors_tensor(self, codes: List[str], dates: pd.DatetimeIndex, 
+                                           tensor: np.ndarray, fields: List[str]):
+        """
+        基于三维行情数组计算所有技术因子，结果与 calculate_technical_factors 一致
+        
+        Args:
+            codes: 股票代码，对应tensor第一维
+            dates: 交易日，对应tensor第二维
+            tensor: (股票数, 交易日数, 字段数) 的行情数组，收盘价为NaN视为当日无数据
+            fields: tensor第三维对应的行情列
+        """
+        close = tensor[:, :, fields.index('收盘')].astype(np.float64)
+        valid = ~np.isnan(close)
+        counts = valid.sum(axis=1)
+        
+        # 把每只股票的有效价格按原顺序挪到行尾，停牌等缺失日不参与计算
+        order = np.argsort(valid, axis=1, kind='stable')
+        packed = np.take_along_axis(close, order, axis=1)
+        n_days = packed.shape[1]
+        
+        factor_values = {}
+        
+        # 计算RSI（使用14天周期），各股票价格首尾相接后只计算最后一个交易日
+        if 'rsi' in self.factors:
+            starts = np.concatenate(([0], np.cumsum(counts)))
+            factor_values['rsi'] = _rsi_wilder_last(close[valid], starts, 14)
+        
+        # 计算波动率（使用20天周期）
+        if 'volatility' in self.factors:
+            if n_days > 20:
+                returns = packed[:, -20:] / packed[:, -21:-1] - 1
+                factor_values['volatility'] = returns.std(axis=1, ddof=1)
+            else:
+                factor_values['volatility'] = np.full(len(codes), np.nan)
+        
+        # 计算动量（使用20天周期）
+        if 'momentum' in self.factors:
+            if n_days > 20:
+                factor_values['momentum'] = packed[:, -1] / packed[:, -21] - 1
+            else:
+                factor_values['momentum'] = np.full(len(codes), np.nan)
+        
+        # 没有任何数据的股票因子值记为0
+        factor_values = {factor: pd.Series(np.where(counts > 0, values, 0.0), index=codes)
+                         for factor, values in factor_values.items()}
+        self.calculate_cross_section_scores(factor_values, codes)
+        
+    def calculate_cross_section_scores(self, factor_values: Dict[str, pd.Series], codes: List[str]):
+        """
+        根据某一交易日的截面因子原始值计算标准化得分
+        
+        Args:
+            factor_values: 因子名 -> 以股票代码为索引的因子原始值
+            codes: 参与打分的股票代码
+        """
+        codes = list(codes)
+        factors = list(factor_values.keys())
+        raw = np.empty((len(codes), len(factors)))
+        for j, factor in enumerate(factors):
+            raw[:, j] = factor_values[factor].reindex(codes).to_numpy(dtype=np.float64)
+        
+        # 所有因子列一次完成标准化，只统计有限值
+        valid = np.isfinite(raw)
+        counts = valid.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, raw, 0.0).sum(axis=0) / counts
+            dev = np.where(valid, raw - mean, 0.0)
+            std = np.sqrt((dev * dev).sum(axis=0) / (counts - 1))
+            std[counts < 2] = np.nan
             
-            # 对每个因子进行标准化
-            for factor in self.factors.keys():
-                if factor in ['rsi', 'volatility', 'momentum']:
-                    # 获取所有股票的该因子得分
-                    scores = {}
-                    for code in self.factor_scores.keys():
-                        if factor in self.factor_scores[code]:
-                            scores[code] = self.factor_scores[code][factor]
-                    
-                    if not scores:
-                        continue
-                        
-                    # 转换为Series
-                    scores_series = pd.Series(scores)
-                    
-                    # 处理无效值
-                    valid_scores = scores_series[pd.notnull(scores_series) & 
-                                               (scores_series != float('inf')) & 
-                                               (scores_series != float('-inf'))]
-                    
-                    if len(valid_scores) > 0:
-                        # 标准化
-                        mean = valid_scores.mean()
-                        std = valid_scores.std()
-                        
-                        if std != 0:
-                            # 对有效值进行标准化
-                            normalized_scores = (scores_series - mean) / std
-                            # 将无效值设置为最小值
-                            normalized_scores[pd.isnull(scores_series) | 
-                                           (scores_series == float('inf')) | 
-                                           (scores_series == float('-inf'))] = -3.0
-                        else:
-                            normalized_scores = scores_series - mean
-                    else:
-                        # 如果所有值都无效，则全部设为0
-                        normalized_scores = pd.Series(0.0, index=scores_series.index)
-                    
-                    # 更新标准化后的得分
-                    for code in self.factor_scores.keys():
-                        if code in normalized_scores.index:
-                            self.factor_scores[code][factor] = float(normalized_scores[code])
-                        else:
-                            self.factor_scores[code][factor] = 0.0
-                    
-        except Exception as e:
-            raise
+            # 对有效值进行标准化，无效值设置为最小值；标准差为0时只去均值
+            scaled = np.where(valid, (raw - mean) / std, -3.0)
+            scaled = np.where(std != 0, scaled, raw - mean)
+        # 如果所有值都无效，则全部设为0
+        scaled[:, counts == 0] = 0.0
+        
+        # 只标准化已添加的技术因子，其余因子保留原始值
+        standardize = np.array([factor in self.factors and factor in ['rsi', 'volatility', 'momentum']
+                                for factor in factors], dtype=bool)
+        scores = np.where(standardize, scaled, raw)
+        self.factor_scores_df = pd.DataFrame(scores, index=codes, columns=factors)
+        
+    def score_at(self, factor_panel: Dict[str, np.ndarray], row: int, codes: List[str], 
+                 mask: np.ndarray = None) -> pd.Series:
+        """
+        从预先算好的因子矩阵中取出某一交易日的截面并计算综合得分
+        
+        Args:
+            factor_panel: 因子名 -> (交易日 × 股票) 因子原始值矩阵，列与codes对齐
+            row: 交易日所在的行号
+            codes: 矩阵各列对应的股票代码
+            mask: 参与打分的股票列，为None时全部参与
+        
+        Returns:
+            以股票代码为索引的综合得分
+        """
+        codes = np.asarray(codes, dtype=object)
+        if mask is not None:
+            codes = codes[mask]
+        codes = codes.tolist()
+        factor_values = {factor: pd.Series(panel[row] if mask is None else panel[row, mask], index=codes)
+                         for factor, panel in factor_panel.items()}
+        self.calculate_cross_section_scores(factor_values, codes)
+        return self.calculate_final_score()
         
     def calculate_final_score(self):
         """计算最终的综合得分"""
-        if not self.factor_scores:
+        if self.factor_scores_df is None or self.factor_scores_df.empty:
             raise ValueError("请先计算技术因子")
             
-        final_scores = {}
-        for code in self.factor_scores.keys():
-            score = 0
-            for factor, weight in self.factors.items():
-                if factor in self.factor_scores[code]:
-                    score += self.factor_scores[code][factor] * weight
-            final_scores[code] = score
+        # 按因子列加权求和，缺失的因子不计入得分
+        factors = [factor for factor in self.factors if factor in self.factor_scores_df.columns]
+        weights = np.array([self.factors[factor] for factor in factors], dtype=np.float64)
+        values = self.factor_scores_df[factors].to_numpy(dtype=np.float64)
+        final_scores = (values * weights).sum(axis=1)
             
-        self.final_scores = pd.Series(final_scores)
+        self.final_scores = pd.Series(final_scores, index=self.factor_scores_df.index)
         return self.final_scores
         
     def select_top_stocks(self, n: int) -> List[Tuple[str, float]]:
@@ -162,14 +357,33 @@ class FactorModel:
         if self.final_scores is None:
             raise ValueError("请先计算最终得分")
             
-        return list(self.final_scores.nlargest(n).items())
+        if n >= len(self.final_scores):
+            return list(self.final_scores.sort_values(ascending=False, kind='stable').items())
+            
+        if n <= 0:
+            return []
+            
+        # 与 nlargest(n) 一致：得分相同时排在前面的股票优先，NaN只在有效得分不足n个时按原顺序补在最后
+        vals = self.final_scores.to_numpy(dtype=np.float64)
+        codes = self.final_scores.index.to_numpy()
+        missing = np.isnan(vals)
+        candidates = np.flatnonzero(~missing)
+        if n < candidates.size:
+            # 部分选择求出第n大的得分，保留所有不低于它的股票，与第n名并列的股票也在其中
+            kth = np.partition(vals[candidates], candidates.size - n)[candidates.size - n]
+            candidates = candidates[vals[candidates] >= kth]
+        # 只对候选股票排序：得分降序，得分相同时按原位置升序
+        idx = candidates[np.lexsort((candidates, -vals[candidates]))[:n]]
+        if idx.size < n:
+            idx = np.concatenate([idx, np.flatnonzero(missing)[:n - idx.size]])
+        return list(zip(codes[idx].tolist(), vals[idx].tolist()))
         
     def get_factor_exposure(self, code: str) -> Dict[str, float]:
         """获取某只股票的因子暴露"""
-        if code not in self.factor_scores:
+        if self.factor_scores_df is None or code not in self.factor_scores_df.index:
             raise ValueError(f"股票 {code} 没有因子数据")
             
-        return {factor: score for factor, score in self.factor_scores[code].items()}
+        return self.factor_scores_df.loc[code].to_dict()
 
     def calculate_market_factor(self, returns, market_returns):
         """计算市场因子"""
@@ -194,65 +408,59 @@ class FactorModel:
     def calculate_all_factors(self, stock_data: Dict[str, pd.DataFrame], market_data: Dict[str, pd.DataFrame], date: str):
         """计算所有因子"""
         try:
-            # 初始化factor_scores
-            self.factor_scores = {}
-            for code in stock_data.keys():
-                self.factor_scores[code] = {}
+            codes = list(stock_data.keys())
+            
+            def zscore(values):
+                """对整个截面一次完成标准化，标准差为0时全部记为0"""
+                values = np.asarray(values, dtype=np.float64)
+                mean = values.mean()
+                std = values.std()
+                return (values - mean) / std if std != 0 else np.zeros_like(values)
             
-            # 计算并存储市场因子
+            # 计算市场因子，只有指数本身有对应的市场收益率
             market_returns = {}
             for code, data in market_data.items():
                 if not data.empty:
                     market_returns[code] = data['收盘'].pct_change().iloc[-1] if len(data) > 1 else 0
                 else:
                     market_returns[code] = 0
+            market = pd.Series(market_returns, dtype=np.float64).reindex(codes, fill_value=0.0)
             
-            for code in stock_data.keys():
-                self.factor_scores[code]['market'] = market_returns.get(code, 0)
+            # 计算规模因子，市值取最后一个交易日的收盘价乘成交量
+            market_caps = np.array([data['收盘'].iloc[-1] * data['成交量'].iloc[-1] if not data.empty else 0
+                                    for data in stock_data.values()], dtype=np.float64)
+            positive = market_caps > 0
+            size_factors = np.zeros(len(codes))
+            size_factors[positive] = np.log(market_caps[positive])
             
-            # 计算并存储规模因子
-            market_caps = {}
-            for code, data in stock_data.items():
-                if not data.empty:
-                    market_caps[code] = data['收盘'].iloc[-1] * data['成交量'].iloc[-1]
-                else:
-                    market_caps[code] = 0
-            
-            size_factors = {code: np.log(cap) if cap > 0 else 0 for code, cap in market_caps.items()}
-            size_mean = np.mean(list(size_factors.values()))
-            size_std = np.std(list(size_factors.values()))
-            for code in stock_data.keys():
-                self.factor_scores[code]['size'] = (size_factors[code] - size_mean) / size_std if size_std != 0 else 0
-            
-            # 计算并存储动量因子
-            momentum = {}
-            for code, data in stock_data.items():
-                if not data.empty and len(data) > 252:
-                    returns = data['收盘'].pct_change()
-                    momentum[code] = returns.rolling(window=252).mean().iloc[-1]
-                else:
-                    momentum[code] = 0
-            
-            momentum_mean = np.mean(list(momentum.values()))
-            momentum_std = np.std(list(momentum.values()))
-            for code in stock_data.keys():
-                self.factor_scores[code]['momentum'] = (momentum[code] - momentum_mean) / momentum_std if momentum_std != 0 else 0
-            
-            # 计算并存储波动率因子
-            volatility = {}
-            for code, data in stock_data.items():
-                if not data.empty and len(data) > 60:
-                    returns = data['收盘'].pct_change()
-                    volatility[code] = returns.rolling(window=60).std().iloc[-1]
-                else:
-                    volatility[code] = 0
-            
-            vol_mean = np.mean(list(volatility.values()))
-            vol_std = np.std(list(volatility.values()))
-            for code in stock_data.keys():
-                self.factor_scores[code]['volatility'] = (volatility[code] - vol_mean) / vol_std if vol_std != 0 else 0
+            # 所有股票的日收益率只计算一次，动量与波动率因子共用
+            lengths = pd.Series([len(data) for data in stock_data.values()], index=codes)
+            momentum = pd.Series(0.0, index=codes)
+            volatility = pd.Series(0.0, index=codes)
+            close = self._stack_close(stock_data)
+            if not close.empty:
+                # 与 pct_change 默认行为一致，缺失的价格沿用前一个值
+                close = close.groupby(level='code', sort=False).ffill()
+                returns = close / close.groupby(level='code', sort=False).shift(1) - 1
+                by_code = returns.groupby(level='code', sort=False)
+                
+                def latest(values):
+                    """每只股票取最后一个交易日的滚动值"""
+                    values = values.droplevel(0).groupby(level='code', sort=False).tail(1)
+                    return values.droplevel('date').reindex(codes)
+                
+                # 数据不足窗口长度的股票因子值记为0
+                momentum = latest(by_code.rolling(window=252).mean()).where(lengths > 252, 0.0)
+                volatility = latest(by_code.rolling(window=60).std()).where(lengths > 60, 0.0)
             
-            return self.factor_scores
+            # 规模、动量、波动率因子整列标准化，市场因子保留原始值
+            self.factor_scores_df = pd.DataFrame({
+                'market': market.to_numpy(),
+                'size': zscore(size_factors),
+                'momentum': zscore(momentum),
+                'volatility': zscore(volatility)
+            }, index=codes)
+            return self.factor_scores_df.to_dict(orient='index')
             
         except Exception as e:
             print(f"计算因子时出错: {str(e)}")
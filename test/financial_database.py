@@ -5,89 +5,232 @@ from datetime import datetime, timedelta
 import os
 import logging
 
+try:
+    import duckdb
+    DUCKDB_AVAILABLE = True
+except ImportError:
+    DUCKDB_AVAILABLE = False
+
+# 财务报表表名
+FINANCIAL_TABLES = ('balance_sheet', 'income_statement', 'cash_flow')
+
+# 公告日期以该格式对应的整数存储（如20240430），查询参数在方法内统一转换
+DATE_FORMAT = '%Y%m%d'
+
+# 各财务报表的表结构，{table}为表名，迁移旧表时复用
+# 主键为整数日期与股票代码，WITHOUT ROWID 使表本身按主键组织，按股票查询无需再回表
+FINANCIAL_SCHEMAS = {
+    'balance_sheet': '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        序号 INTEGER,
+        股票代码 TEXT NOT NULL,
+        股票简称 TEXT,
+        资产货币资金 REAL,
+        资产应收账款 REAL,
+        资产存货 REAL,
+        资产总资产 REAL,
+        资产总资产同比 REAL,
+        负债应付账款 REAL,
+        负债预收账款 REAL,
+        负债总负债 REAL,
+        负债总负债同比 REAL,
+        资产负债率 REAL,
+        股东权益合计 REAL,
+        公告日期 INTEGER NOT NULL,
+        PRIMARY KEY (股票代码, 公告日期)
+    ) WITHOUT ROWID
+    ''',
+    'income_statement': '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        序号 INTEGER,
+        股票代码 TEXT NOT NULL,
+        股票简称 TEXT,
+        净利润 REAL,
+        净利润同比 REAL,
+        营业总收入 REAL,
+        营业总收入同比 REAL,
+        营业总支出营业支出 REAL,
+        营业总支出销售费用 REAL,
+        营业总支出管理费用 REAL,
+        营业总支出财务费用 REAL,
+        营业总支出营业总支出 REAL,
+        营业利润 REAL,
+        利润总额 REAL,
+        公告日期 INTEGER NOT NULL,
+        PRIMARY KEY (股票代码, 公告日期)
+    ) WITHOUT ROWID
+    ''',
+    'cash_flow': '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        序号 INTEGER,
+        股票代码 TEXT NOT NULL,
+        股票简称 TEXT,
+        净现金流净现金流 REAL,
+        净现金流同比增长 REAL,
+        经营性现金流现金流量净额 REAL,
+        经营性现金流净现金流占比 REAL,
+        投资性现金流现金流量净额 REAL,
+        投资性现金流净现金流占比 REAL,
+        融资性现金流现金流量净额 REAL,
+        融资性现金流净现金流占比 REAL,
+        公告日期 INTEGER NOT NULL,
+        PRIMARY KEY (股票代码, 公告日期)
+    ) WITHOUT ROWID
+    ''',
+}
+
+# 旧版文本公告日期转换为整数 yyyymmdd 的SQL表达式，迁移旧表时使用
+DATE_KEY_SQL = "CAST(strftime('%Y%m%d', 公告日期) AS INTEGER)"
+
+# 按公告日期查询用的二级索引，主键 (股票代码, 公告日期) 无法用于只按日期的查询
+DATE_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_{table}_date ON {table}(公告日期)'
+
+# 保存财务报表时每批写入的行数，按批转换为参数元组，避免一次性展开整张表
+SAVE_CHUNK_SIZE = 10000
+
 class FinancialDatabase:
     def __init__(self, db_path='data/financial_data.db'):
         """初始化数据库连接"""
         self.db_path = db_path
         self.conn = sqlite3.connect(db_path)
+        # WAL模式下读取不阻塞写入，批量保存时每次提交也不必完整同步到磁盘
+        self.conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;
+        ''')
         self.create_tables()
+        # 建表后缓存已有的表名，查询时不必每次访问 sqlite_master
+        self._tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        # 查询优先走 DuckDB，写入始终使用SQLite连接
+        self.duck = self._attach_duckdb()
         logging.info(f"成功连接到数据库: {db_path}")
         
     def create_tables(self):
         cursor = self.conn.cursor()
         
-        # 创建资产负债表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS balance_sheet (
-            序号 INTEGER,
-            股票代码 TEXT,
-            股票简称 TEXT,
-            资产货币资金 REAL,
-            资产应收账款 REAL,
-            资产存货 REAL,
-            资产总资产 REAL,
-            资产总资产同比 REAL,
-            负债应付账款 REAL,
-            负债预收账款 REAL,
-            负债总负债 REAL,
-            负债总负债同比 REAL,
-            资产负债率 REAL,
-            股东权益合计 REAL,
-            公告日期 TEXT,
-            PRIMARY KEY (股票代码, 公告日期)
-        )
-        ''')
-
-        # 创建利润表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS income_statement (
-            序号 INTEGER,
-            股票代码 TEXT,
-            股票简称 TEXT,
-            净利润 REAL,
-            净利润同比 REAL,
-            营业总收入 REAL,
-            营业总收入同比 REAL,
-            营业总支出营业支出 REAL,
-            营业总支出销售费用 REAL,
-            营业总支出管理费用 REAL,
-            营业总支出财务费用 REAL,
-            营业总支出营业总支出 REAL,
-            营业利润 REAL,
-            利润总额 REAL,
-            公告日期 TEXT,
-            PRIMARY KEY (股票代码, 公告日期)
-        )
-        ''')
-
-        # 创建现金流量表
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cash_flow (
-            序号 INTEGER,
-            股票代码 TEXT,
-            股票简称 TEXT,
-            净现金流净现金流 REAL,
-            净现金流同比增长 REAL,
-            经营性现金流现金流量净额 REAL,
-            经营性现金流净现金流占比 REAL,
-            投资性现金流现金流量净额 REAL,
-            投资性现金流净现金流占比 REAL,
-            融资性现金流现金流量净额 REAL,
-            融资性现金流净现金流占比 REAL,
-            公告日期 TEXT,
-            PRIMARY KEY (股票代码, 公告日期)
-        )
-        ''')
+        # 创建资产负债表、利润表、现金流量表
+        for table in FINANCIAL_TABLES:
+            cursor.execute(FINANCIAL_SCHEMAS[table].format(table=table))
+        self.conn.commit()
+        
+        for table in FINANCIAL_TABLES:
+            self._migrate_table(table)
+            self.conn.execute(DATE_INDEX_SQL.format(table=table))
 
         self.conn.commit()
         logging.info("数据表创建成功")
+        
+    def _migrate_table(self, table):
+        """
+        将旧版以文本存储公告日期、带rowid的财务报表重建为整数日期的WITHOUT ROWID表
+        
+        主键重复的记录只保留最早写入的一条，其余记录与缺少股票代码或公告日期的记录
+        原样移入 {table}_dropped 表并逐条记录日志，迁移不会丢失任何数据
+        """
+        row = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if row is None or 'WITHOUT ROWID' in row[0].upper():
+            return
+        columns = [info[1] for info in self.conn.execute(f"PRAGMA table_info({table})")]
+        
+        # 迁移前先统计迁移后主键冲突的股票代码与公告日期
+        for code, date, count in self.conn.execute(f'''
+            SELECT 股票代码, {DATE_KEY_SQL}, COUNT(*) FROM {table}
+            WHERE 股票代码 IS NOT NULL AND {DATE_KEY_SQL} IS NOT NULL
+            GROUP BY 股票代码, {DATE_KEY_SQL}
+            HAVING COUNT(*) > 1
+        '''):
+            logging.warning(f"表 {table} 中股票 {code} 公告日期 {date} 有 {count} 条记录，迁移时只保留最早写入的一条")
+        
+        # 无法写入新表的记录：缺少主键，或不是重复记录中最早写入的一条
+        dropped_rowids = f'''
+            SELECT rowid FROM {table}
+            WHERE 股票代码 IS NULL OR {DATE_KEY_SQL} IS NULL
+               OR rowid NOT IN (SELECT MIN(rowid) FROM {table} GROUP BY 股票代码, {DATE_KEY_SQL})
+        '''
+        dropped = self.conn.execute(
+            f"SELECT rowid, 股票代码, 公告日期 FROM {table} WHERE rowid IN ({dropped_rowids})"
+        ).fetchall()
+        
+        with self.conn:
+            # 建表、拷贝、改名放在同一事务中，中途失败时旧表保持不变
+            self.conn.execute("BEGIN")
+            if dropped:
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_dropped AS SELECT * FROM {table} WHERE 0")
+                self.conn.execute(f"INSERT INTO {table}_dropped SELECT * FROM {table} WHERE rowid IN ({dropped_rowids})")
+                for rowid, code, date in dropped:
+                    logging.warning(f"表 {table} 的记录 rowid={rowid}（股票代码={code}，公告日期={date}）"
+                                    f"无法写入迁移后的表，已移入 {table}_dropped")
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}_new")
+            self.conn.execute(FINANCIAL_SCHEMAS[table].format(table=f"{table}_new"))
+            new_columns = [info[1] for info in self.conn.execute(f"PRAGMA table_info({table}_new)")]
+            shared = [col for col in new_columns if col in columns]
+            select = ', '.join(DATE_KEY_SQL if col == '公告日期' else f'"{col}"' for col in shared)
+            # 不使用 OR REPLACE，出现未预料的主键冲突时整个迁移回滚而不是覆盖记录
+            self.conn.execute(f'''
+                INSERT INTO {table}_new ({', '.join(f'"{col}"' for col in shared)})
+                SELECT {select} FROM {table}
+                WHERE rowid NOT IN ({dropped_rowids})
+            ''')
+            self.conn.execute(f"DROP TABLE {table}")
+            self.conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        logging.info(f"已将表 {table} 迁移为整数公告日期")
             
+    def _save_table(self, table, df):
+        """
+        整表替换写入财务报表：清空原有数据与批量插入在同一事务中完成
+        
+        只写入表结构中存在的列，数据中缺少的列写入NULL；公告日期转换为整数 yyyymmdd，
+        缺少股票代码或公告日期的记录不满足主键约束，不写入。
+        数据按 SAVE_CHUNK_SIZE 行分批写入，所有批次在同一事务中提交
+        
+        Returns:
+            写入的记录数
+        """
+        columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+        dates = pd.to_datetime(df['公告日期'], format='ISO8601', cache=True)
+        valid = (df['股票代码'].notna() & dates.notna()).to_numpy(dtype=bool)
+        if not valid.all():
+            logging.warning(f"{(~valid).sum()} 条记录缺少股票代码或公告日期，不写入表 {table}")
+            df, dates = df[valid], dates[valid]
+        
+        date_keys = dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day
+        
+        column_list = ', '.join(f'"{col}"' for col in columns)
+        placeholders = ', '.join('?' * len(columns))
+        with self.conn:
+            # 索引的删除与重建也放在同一事务中，写入失败回滚时索引一并恢复
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            # 先删除日期索引，全部写入后再一次性重建，避免逐行维护索引
+            self.conn.execute(f"DROP INDEX IF EXISTS idx_{table}_date")
+            self.conn.execute(f"DELETE FROM {table}")
+            insert_sql = f"INSERT OR REPLACE INTO {table} ({column_list}) VALUES ({placeholders})"
+            for start in range(0, len(df), SAVE_CHUNK_SIZE):
+                end = start + SAVE_CHUNK_SIZE
+                values = []
+                for col in columns:
+                    if col == '公告日期':
+                        values.append(date_keys.iloc[start:end].tolist())
+                    elif col in df.columns:
+                        # Arrow等扩展类型的缺失值为pd.NA，统一转换为None后才能绑定到SQL参数
+                        values.append(df[col].iloc[start:end].to_numpy(dtype=object, na_value=None).tolist())
+                    else:
+                        values.append([None] * (min(end, len(df)) - start))
+                self.conn.executemany(insert_sql, zip(*values))
+            self.conn.execute(DATE_INDEX_SQL.format(table=table))
+        return len(df)
+        
     def save_balance_sheet(self, df):
         """保存资产负债表数据"""
         try:
             # 保存数据
-            df.to_sql('balance_sheet', self.conn, if_exists='replace', index=False)
-            logging.info(f"成功保存资产负债表数据")
+            count = self._save_table('balance_sheet', df)
+            logging.info(f"成功保存资产负债表数据，共 {count} 条记录")
         except Exception as e:
             logging.error(f"保存资产负债表数据失败: {str(e)}")
             raise
@@ -96,8 +239,8 @@ class FinancialDatabase:
         """保存利润表数据"""
         try:
             # 保存数据
-            df.to_sql('income_statement', self.conn, if_exists='replace', index=False)
-            logging.info(f"成功保存利润表数据")
+            count = self._save_table('income_statement', df)
+            logging.info(f"成功保存利润表数据，共 {count} 条记录")
         except Exception as e:
             logging.error(f"保存利润表数据失败: {str(e)}")
             raise
@@ -106,22 +249,78 @@ class FinancialDatabase:
         """保存现金流量表数据"""
         try:
             # 保存数据
-            df.to_sql('cash_flow', self.conn, if_exists='replace', index=False)
-            logging.info(f"成功保存现金流量表数据")
+            count = self._save_table('cash_flow', df)
+            logging.info(f"成功保存现金流量表数据，共 {count} 条记录")
         except Exception as e:
             logging.error(f"保存现金流量表数据失败: {str(e)}")
             raise
             
-    def get_balance_sheet(self, stock_code=None, date=None):
-        """获取资产负债表数据"""
-        query = "SELECT * FROM balance_sheet"
+    def _attach_duckdb(self):
+        """
+        安装了 duckdb 时以只读方式挂载同一个SQLite文件，查询结果按列直接转换为DataFrame
+        
+        Returns:
+            DuckDB连接；未安装 duckdb 或挂载失败时返回None，查询退回SQLite
+        """
+        if not DUCKDB_AVAILABLE or self.db_path == ':memory:':
+            return None
+        try:
+            duck = duckdb.connect()
+            path = self.db_path.replace("'", "''")
+            duck.execute(f"ATTACH '{path}' AS financial (TYPE SQLITE, READ_ONLY)")
+            duck.execute("USE financial")
+            return duck
+        except Exception as e:
+            logging.warning(f"DuckDB挂载失败，查询使用SQLite: {str(e)}")
+            return None
+        
+    def _read_sql(self, query, params=()):
+        """执行查询并将整数公告日期解析为日期类型"""
+        if self.duck is None:
+            # 直接由游标结果构造DataFrame，省去 read_sql_query 的通用封装
+            cursor = self.conn.execute(query, params)
+            df = pd.DataFrame.from_records(cursor.fetchall(), coerce_float=True,
+                                           columns=[desc[0] for desc in cursor.description])
+        else:
+            df = self.duck.execute(query, list(params)).df()
+        if '公告日期' in df.columns:
+            df['公告日期'] = pd.to_datetime(df['公告日期'], format=DATE_FORMAT)
+        return df
+        
+    def _build_query(self, table, stock_code=None, date=None):
+        """
+        构建按股票代码和公告日期筛选的参数化查询
+        
+        Returns:
+            query: SQL语句
+            params: 查询参数，日期转换为整数 yyyymmdd
+        """
+        query = f"SELECT * FROM {table}"
+        conditions = []
+        params = []
+        
         if stock_code:
-            query += f" WHERE 股票代码 = '{stock_code}'"
+            conditions.append("股票代码 = ?")
+            params.append(stock_code)
+            
         if date:
-            query += f" AND 公告日期 = '{date}'" if stock_code else f" WHERE 公告日期 = '{date}'"
-        cursor = self.conn.cursor()
-        df = pd.read_sql_query(query, self.conn)
-        return df
+            # 标准化日期格式
+            try:
+                date = int(pd.to_datetime(date).strftime(DATE_FORMAT))
+            except Exception as e:
+                logging.error(f"日期格式转换错误: {str(e)}")
+                raise ValueError(f"无效的日期格式: {date}")
+            conditions.append("公告日期 = ?")
+            params.append(date)
+            
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+        
+    def get_balance_sheet(self, stock_code=None, date=None):
+        """获取资产负债表数据"""
+        query, params = self._build_query('balance_sheet', stock_code, date)
+        return self._read_sql(query, params)
             
     def get_income_statement(self, stock_code=None, date=None):
         """获取利润表数据"""
@@ -131,46 +330,23 @@ class FinancialDatabase:
                 raise ConnectionError("数据库连接未建立")
                 
             # 检查表是否存在
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='income_statement'")
-            if not cursor.fetchone():
+            if 'income_statement' not in self._tables:
                 raise ValueError("利润表不存在，请先导入数据")
                 
             # 构建查询语句
-            query = "SELECT * FROM income_statement"
-            params = []
-            
-            if stock_code or date:
-                query += " WHERE"
-                conditions = []
+            query, params = self._build_query('income_statement', stock_code, date)
                 
-                if stock_code:
-                    conditions.append(" 股票代码 = ?")
-                    params.append(stock_code)
-                    
-                if date:
-                    # 标准化日期格式
-                    try:
-                        date = pd.to_datetime(date).strftime('%Y-%m-%d')
-                        conditions.append(" 公告日期 = ?")
-                        params.append(date)
-                    except Exception as e:
-                        logging.error(f"日期格式转换错误: {str(e)}")
-                        raise ValueError(f"无效的日期格式: {date}")
-                        
-                query += " AND".join(conditions)
-                
-            logging.info(f"执行查询: {query}")
-            logging.info(f"查询参数: {params}")
+            logging.debug(f"执行查询: {query}")
+            logging.debug(f"查询参数: {params}")
             
             # 执行查询
-            df = pd.read_sql_query(query, self.conn, params=params)
+            df = self._read_sql(query, params)
             
             # 检查结果
             if df.empty:
                 logging.warning(f"未找到利润表数据: stock_code={stock_code}, date={date}")
             else:
-                logging.info(f"成功获取利润表数据，共 {len(df)} 条记录")
+                logging.debug(f"成功获取利润表数据，共 {len(df)} 条记录")
                 
             return df
             
@@ -180,17 +356,98 @@ class FinancialDatabase:
             
     def get_cash_flow(self, stock_code=None, date=None):
         """获取现金流量表数据"""
-        query = "SELECT * FROM cash_flow"
-        if stock_code:
-            query += f" WHERE 股票代码 = '{stock_code}'"
-        if date:
-            query += f" AND 公告日期 = '{date}'" if stock_code else f" WHERE 公告日期 = '{date}'"
-        cursor = self.conn.cursor()
-        df = pd.read_sql_query(query, self.conn)
-        return df
+        query, params = self._build_query('cash_flow', stock_code, date)
+        return self._read_sql(query, params)
+            
+    def _check_table(self, table):
+        """校验表名，表名会直接拼接进SQL语句"""
+        if table not in FINANCIAL_TABLES:
+            raise ValueError(f"未知的财务报表: {table}")
+            
+    def count(self, table):
+        """返回表中的记录数"""
+        self._check_table(table)
+        return self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        
+    def head(self, table, n=5):
+        """返回表中的前n条记录"""
+        self._check_table(table)
+        return self._read_sql(f"SELECT * FROM {table} LIMIT ?", [n])
+        
+    def describe(self, table):
+        """
+        在SQLite中聚合数值列的统计信息，不把整表读入内存
+        
+        Returns:
+            以count、mean、std、min、max为行、数值列为列的DataFrame
+        """
+        self._check_table(table)
+        # 公告日期虽以整数存储，但不是数值指标，不参与统计
+        columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")
+                   if row[2].upper() in ('REAL', 'INTEGER') and row[1] != '公告日期']
+        if not columns:
+            return pd.DataFrame(index=['count', 'mean', 'std', 'min', 'max'])
+            
+        aggregates = ', '.join(
+            f'COUNT("{col}"), SUM("{col}"), MIN("{col}"), MAX("{col}")'
+            for col in columns
+        )
+        row = self.conn.execute(f"SELECT {aggregates} FROM {table}").fetchone()
+        stats = np.array(row, dtype=np.float64).reshape(len(columns), 4)
+        count, total = stats[:, 0], stats[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+        
+        # 第二遍对离均差平方求和；财务数值可达1e12，Σx²−Σx·mean 两项几乎相等，相减会丢失有效数字
+        deviations = ', '.join(f'SUM(("{col}" - ?) * ("{col}" - ?))' for col in columns)
+        params = [None if np.isnan(m) else float(m) for m in mean for _ in range(2)]
+        row = self.conn.execute(f"SELECT {deviations} FROM {table}", params).fetchone()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(np.array(row, dtype=np.float64) / (count - 1))
+        return pd.DataFrame([count, mean, std, stats[:, 2], stats[:, 3]],
+                            index=['count', 'mean', 'std', 'min', 'max'], columns=columns)
+            
+    def dropped_rows(self, table):
+        """
+        返回迁移旧表时因主键重复或缺失而移出的记录
+        
+        Returns:
+            {table}_dropped 表中的原始记录，公告日期保持旧表中的文本；没有移出记录时返回空DataFrame
+        """
+        self._check_table(table)
+        if f"{table}_dropped" not in self._tables:
+            return pd.DataFrame()
+        return pd.read_sql_query(f"SELECT * FROM {table}_dropped", self.conn)
+        
+    def find_duplicates(self, table, keys=('股票代码', '公告日期')):
+        """
+        在SQLite中按键分组查找重复记录
+        
+        Returns:
+            键重复的全部记录，按键排序；没有重复时返回空DataFrame
+        """
+        self._check_table(table)
+        columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+        missing = [key for key in keys if key not in columns]
+        if missing:
+            raise ValueError(f"表 {table} 中没有列: {missing}")
+            
+        key_list = ', '.join(f'"{key}"' for key in keys)
+        query = f'''
+        SELECT t.* FROM {table} t
+        JOIN (
+            SELECT {key_list} FROM {table}
+            GROUP BY {key_list}
+            HAVING COUNT(*) > 1
+        ) d USING ({key_list})
+        ORDER BY {', '.join(f't."{key}"' for key in keys)}
+        '''
+        return self._read_sql(query)
             
     def close(self):
         """关闭数据库连接"""
+        if self.duck is not None:
+            self.duck.close()
         if self.conn:
             self.conn.close()
             logging.info("数据库连接已关闭") 
\ No newline at end of file
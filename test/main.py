@@ -6,14 +6,16 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database import StockDatabase
 from factor_model import FactorModel
 from backtest import Backtest
+from numba_utils import njit
 from data_loader import StockDataLoader
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 from typing import Dict, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import logging
+import hashlib
+import pickle
 
 # 配置日志记录
 def setup_logging():
@@ -39,6 +41,11 @@ def setup_logging():
     
     return log_filename
 
+# 训练集与测试集划分结果的磁盘缓存，参数与数据库版本都相同时直接复用
+SPLIT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'splits.pkl')
+# 缓存文件头，缓存格式变化时修改版本号使旧缓存失效
+SPLIT_CACHE_MAGIC = b'multi-factor-splits-v2\n'
+
 def split_data(data: pd.DataFrame, test_days: int = 252) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     将数据按时间顺序划分为训练集和测试集
@@ -55,6 +62,36 @@ def split_data(data: pd.DataFrame, test_days: int = 252) -> Tuple[pd.DataFrame,
         raise ValueError(f"数据长度不足{test_days}天，无法进行划分")
     return data.iloc[:-test_days], data.iloc[-test_days:]
 
+@njit(cache=True)
+def _metrics_kernel(r):
+    """
+    单次遍历日收益率，同时累计净值、回撤与方差
+    
+    Returns:
+        total_return: 总收益率
+        std: 日收益率样本标准差，少于两个数据时为NaN
+        max_drawdown: 最大回撤（非正数）
+    """
+    n = r.shape[0]
+    equity = 1.0
+    peak = -np.inf
+    max_drawdown = 0.0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(n):
+        equity *= 1.0 + r[i]
+        if equity > peak:
+            peak = equity
+        drawdown = equity / peak - 1.0
+        if drawdown < max_drawdown:
+            max_drawdown = drawdown
+        # Welford 算法累计均值与方差
+        delta = r[i] - mean
+        mean += delta / (i + 1)
+        m2 += delta * (r[i] - mean)
+    std = np.sqrt(m2 / (n - 1)) if n > 1 else np.nan
+    return equity - 1.0, std, max_drawdown
+
 def calculate_performance_metrics(returns: pd.Series) -> Dict[str, float]:
     """
     计算回测性能指标
@@ -65,24 +102,19 @@ def calculate_performance_metrics(returns: pd.Series) -> Dict[str, float]:
     Returns:
         包含各项指标的字典
     """
-    # 计算总收益率
-    total_return = (1 + returns).prod() - 1
+    r = np.asarray(returns, dtype=np.float64)
+    total_return, returns_std, max_drawdown = _metrics_kernel(r)
     
     # 计算年化收益率
-    annual_return = (1 + total_return) ** (252 / len(returns)) - 1
+    annual_return = (1 + total_return) ** (252 / len(r)) - 1
     
     # 计算年化波动率
-    annual_volatility = returns.std() * np.sqrt(252)
+    annual_volatility = returns_std * np.sqrt(252)
     
     # 计算夏普比率（假设无风险利率为3%）
     risk_free_rate = 0.03
     sharpe_ratio = (annual_return - risk_free_rate) / annual_volatility if annual_volatility != 0 else 0
     
-    # 计算最大回撤
-    cummax = (1 + returns).cumprod().cummax()
-    drawdown = (1 + returns).cumprod() / cummax - 1
-    max_drawdown = drawdown.min()
-    
     return {
         'annual_return': annual_return,
         'annual_volatility': annual_volatility,
@@ -100,64 +132,88 @@ def filter_stocks(stock_list: pd.DataFrame) -> pd.DataFrame:
     Returns:
         筛选后的股票列表DataFrame
     """
-    # 剔除创业板股票（代码以30开头）
-    filtered_stocks = stock_list[~stock_list['code'].str.startswith('30')]
-    
-    # 剔除科创板股票（代码以68开头）
-    filtered_stocks = filtered_stocks[~filtered_stocks['code'].str.startswith('68')]
+    # 剔除创业板股票（代码以30开头）和科创板股票（代码以68开头）
+    # 6位数字代码转为数值后整除10000即得前两位，一次数组比较代替字符串前缀匹配
+    codes = stock_list['code']
+    code = pd.to_numeric(codes, errors='coerce').to_numpy(dtype=np.float64)
+    prefix = code // 10000
+    mask = (prefix != 30) & (prefix != 68)
+    # 不是6位数字的代码（位数不足、丢失前导零或含非数字字符）仍按字符串前缀判断
+    regular = ((codes.str.len() == 6) & codes.str.isdigit()).to_numpy(dtype=bool) & ~np.isnan(code)
+    irregular = ~regular
+    if irregular.any():
+        mask[irregular] = ~codes[irregular].str.startswith(('30', '68')).to_numpy(dtype=bool)
     
-    # 剔除ST股票（名字中包含ST）
-    filtered_stocks = filtered_stocks[~filtered_stocks['name'].str.contains('ST', case=False)]
+    # 剔除ST股票（名字中包含ST），忽略大小写按普通子串查找，不编译正则
+    mask &= ~stock_list['name'].str.contains('ST', case=False, regex=False).to_numpy(dtype=bool)
     
-    return filtered_stocks
+    # 合并为一个布尔掩码后只筛选一次
+    return stock_list[mask]
 
-def process_stock_data(args):
+def load_split_data(db: StockDatabase, codes, start_date: datetime, end_date: datetime):
     """
-    处理单只股票的数据
+    读取股票数据并以 start_date 为界划分训练集与测试集，结果缓存到 SPLIT_CACHE_PATH
     
-    Args:
-        args: 包含数据库连接、股票代码、开始日期和结束日期的元组
+    缓存键包含股票代码、起止日期与数据库文件版本，数据库被写入后缓存自动失效
     
     Returns:
-        处理结果字典，包含股票代码和处理后的数据
+        all_data: 所有股票历史数据的长表
+        stock_data: 股票代码到全部历史数据的字典
+        test_data: 股票代码到测试集数据的字典
+        loaded: (股票代码, 训练集记录数, 测试集记录数) 列表
     """
-    db, code, start_date, end_date = args
-    try:
-        # 获取所有历史数据
-        all_data = db.get_stock_data(code, None, end_date)
-        if all_data is not None and not all_data.empty:
-            # 按时间排序
-            all_data = all_data.sort_index()
-            
-            # 获取最近一年的数据作为测试集
-            test_data = all_data[all_data.index >= start_date]
-            # 获取之前的所有数据作为训练集
-            train_data = all_data[all_data.index < start_date]
-            
-            if len(train_data) > 0 and len(test_data) > 0:
-                # 记录获取的数据信息到日志
-                logging.info(f"成功从数据库获取股票 {code} 的数据，共 {len(all_data)} 条记录")
-                
-                return {
-                    'code': code,
-                    'data': all_data,
-                    'train': train_data,
-                    'test': test_data,
-                    'success': True,
-                    'message': None
-                }
-    except Exception as e:
-        logging.error(f"处理股票 {code} 数据时出错: {str(e)}")
-        return {
-            'code': code,
-            'success': False,
-            'message': None
-        }
-    return {
-        'code': code,
-        'success': False,
-        'message': None
-    }
+    codes = list(codes)
+    # 行情数据只到日级别，同一天内 end_date 不同不影响查询结果
+    key = (codes, start_date, end_date.date(), db.file_version())
+    # 文件头写入缓存键的摘要，只有文件头与本次缓存键一致的文件才会被反序列化
+    digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest().encode('ascii') + b'\n'
+    if os.path.exists(SPLIT_CACHE_PATH):
+        try:
+            with open(SPLIT_CACHE_PATH, 'rb') as f:
+                if f.readline() == SPLIT_CACHE_MAGIC and f.readline() == digest:
+                    result = pickle.load(f)
+                    logging.info("使用缓存的训练集与测试集划分结果")
+                    return result
+        except Exception as e:
+            logging.warning(f"读取划分结果缓存失败，重新读取数据库: {str(e)}")
+    
+    # 一次查询取出所有股票的历史数据，再按股票代码拆分
+    # 因子计算与回测只用到OHLCV，不读取成交额；价格列读取为float32，内存占用减半
+    all_data = db.get_all_stock_data(None, end_date, codes=codes,
+                                     columns=['开盘', '收盘', '最高', '最低', '成交量'],
+                                     dtype=np.float32)
+    grouped = dict(tuple(all_data.groupby('code', sort=False, observed=True)))
+    
+    stock_data = {}
+    test_data = {}
+    loaded = []  # (股票代码, 训练集记录数, 测试集记录数)
+    
+    for code in tqdm(codes, desc="处理进度"):
+        if code not in grouped:
+            continue
+        data = grouped[code].drop(columns='code').set_index('date')
+        
+        # 数据按日期升序排列，首尾日期即可判断能否划分，不能划分时直接跳过
+        if not (data.index[0] < start_date <= data.index[-1]):
+            continue
+        
+        # 获取最近一年的数据作为测试集，之前的所有数据作为训练集
+        # 查询已按日期排序，二分查找测试集起点后切片，不必为整列生成布尔掩码
+        split = data.index.searchsorted(start_date)
+        stock_data[code] = data
+        test_data[code] = data.iloc[split:]
+        loaded.append((code, split, len(data) - split))
+    
+    result = (all_data, stock_data, test_data, loaded)
+    # 先写临时文件再替换，中途失败不会留下损坏的缓存
+    os.makedirs(os.path.dirname(SPLIT_CACHE_PATH), exist_ok=True)
+    tmp_path = SPLIT_CACHE_PATH + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SPLIT_CACHE_MAGIC)
+        f.write(digest)
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, SPLIT_CACHE_PATH)
+    return result
 
 def main():
     try:
@@ -186,31 +242,20 @@ def main():
         stock_list = filter_stocks(stock_list)
         logging.info(f"剔除ST股票和创业板股票后剩余 {len(stock_list)} 只股票")
         
-        # 准备并行处理参数
-        process_args = [(db, code, start_date, end_date) for code in stock_list['code']]
-        
-        # 使用线程池并行处理股票数据
-        logging.info("正在并行处理股票数据...")
-        stock_data = {}
-        train_data = {}
-        test_data = {}
-        success_count = 0
+        # 先剔除无法划分训练集与测试集的股票，不读取它们的数据
+        eligible_codes = db.get_eligible_codes(start_date, end_date)
+        stock_list = stock_list[stock_list['code'].isin(eligible_codes)]
+        logging.info(f"同时具有训练与测试数据的股票 {len(stock_list)} 只")
         
-        with ThreadPoolExecutor(max_workers=min(32, len(stock_list))) as executor:
-            # 使用tqdm显示进度条
-            futures = [executor.submit(process_stock_data, args) for args in process_args]
-            for future in tqdm(as_completed(futures), total=len(futures), desc="处理进度"):
-                result = future.result()
-                if result['success']:
-                    code = result['code']
-                    stock_data[code] = result['data']
-                    train_data[code] = result['train']
-                    test_data[code] = result['test']
-                    success_count += 1
+        logging.info("正在从数据库读取股票数据...")
+        all_data, stock_data, test_data, loaded = load_split_data(db, stock_list['code'], start_date, end_date)
         
         if not stock_data:
             raise ValueError("没有获取到有效的股票数据")
-        logging.info(f"成功处理 {success_count} 只股票的数据")
+        # 循环结束后统一记录汇总信息
+        logging.info(f"成功处理 {len(loaded)} 只股票的数据，"
+                     f"训练集共 {sum(n for _, n, _ in loaded)} 条记录，"
+                     f"测试集共 {sum(n for _, _, n in loaded)} 条记录")
         
         # 初始化因子模型
         logging.info("开始因子计算...")
@@ -222,27 +267,32 @@ def main():
             factor_model.add_factor('volatility', 0.3)  # 波动率因子，权重0.3
             factor_model.add_factor('momentum', 0.3)  # 动量因子，权重0.3
             
-            # 使用训练集数据计算所有因子
+            # 将训练集堆叠为 (股票数, 交易日数, 字段数) 的数组后计算所有因子
             logging.info("计算技术因子...")
-            factor_model.calculate_technical_factors(train_data, end_date.strftime('%Y-%m-%d'))
+            train_fields = ['开盘', '最高', '最低', '收盘', '成交量']
+            codes, dates, train_tensor = factor_model.build_factor_tensor(
+                all_data[all_data['date'] < start_date], list(stock_data), train_fields)
+            factor_model.calculate_technical_factors_tensor(codes, dates, train_tensor, train_fields)
             
             # 计算最终得分
             logging.info("计算最终得分...")
-            final_scores = factor_model.calculate_final_score()
+            factor_model.calculate_final_score()
             
-            # 选择得分最高的3只股票
-            top_stocks = final_scores.nlargest(3)
+            # 选择得分最高的3只股票（部分选择，只对前3名排序）
+            top_stocks = factor_model.select_top_stocks(3)
+            stock_names = dict(zip(stock_list['code'], stock_list['name']))
             logging.info("选出的股票：")
-            for code, score in top_stocks.items():
-                stock_name = stock_list[stock_list['code'] == code]['name'].iloc[0]
+            for code, score in top_stocks:
+                stock_name = stock_names[code]
                 logging.info(f"股票 {code} ({stock_name}): 得分 {score:.4f}")
             
             # 使用测试集数据进行回测
             logging.info("开始回测...")
+            sample_index = test_data[next(iter(test_data))].index
             backtest = Backtest(
                 stock_data=test_data,  # 传入所有可交易的股票数据
-                start_date=test_data[list(test_data.keys())[0]].index[0],
-                end_date=test_data[list(test_data.keys())[0]].index[-1],
+                start_date=sample_index[0],
+                end_date=sample_index[-1],
                 factor_model=factor_model,
                 rebalance_period=20,  # 每月调仓（约20个交易日）
                 top_n=3
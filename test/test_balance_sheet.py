@@ -1,11 +1,44 @@
 import akshare as ak
 import pandas as pd
 from datetime import datetime, timedelta
+from functools import lru_cache
 import sys
 import os
 import logging
 from financial_database import FinancialDatabase
 
+# akshare 原始列名到数据库列名的映射
+BS_COLUMN_MAP = {
+    '资产-货币资金': '资产货币资金',
+    '资产-应收账款': '资产应收账款',
+    '资产-存货': '资产存货',
+    '资产-总资产': '资产总资产',
+    '资产-总资产同比': '资产总资产同比',
+    '负债-应付账款': '负债应付账款',
+    '负债-预收账款': '负债预收账款',
+    '负债-总负债': '负债总负债',
+    '负债-总负债同比': '负债总负债同比'
+}
+
+IS_COLUMN_MAP = {
+    '营业总支出-营业支出': '营业总支出营业支出',
+    '营业总支出-销售费用': '营业总支出销售费用',
+    '营业总支出-管理费用': '营业总支出管理费用',
+    '营业总支出-财务费用': '营业总支出财务费用',
+    '营业总支出-营业总支出': '营业总支出营业总支出'
+}
+
+CF_COLUMN_MAP = {
+    '净现金流-净现金流': '净现金流净现金流',
+    '净现金流-同比增长': '净现金流同比增长',
+    '经营性现金流-现金流量净额': '经营性现金流现金流量净额',
+    '经营性现金流-净现金流占比': '经营性现金流净现金流占比',
+    '投资性现金流-现金流量净额': '投资性现金流现金流量净额',
+    '投资性现金流-净现金流占比': '投资性现金流净现金流占比',
+    '融资性现金流-现金流量净额': '融资性现金流现金流量净额',
+    '融资性现金流-净现金流占比': '融资性现金流净现金流占比'
+}
+
 # 设置日志
 def setup_logging():
     log_dir = 'logs'
@@ -27,7 +60,11 @@ def setup_logging():
     logging.info(f'日志文件保存在: {log_file}')
 
 def get_quarter_end_date():
-    today = datetime.now()
+    # 同一天内结果不变，按日期缓存
+    return _quarter_end_date(datetime.now().date())
+
+@lru_cache(maxsize=1)
+def _quarter_end_date(today):
     if today.month <= 3:
         return f"{today.year-2}1231"
     elif today.month <= 6:
@@ -37,6 +74,13 @@ def get_quarter_end_date():
     else:
         return f"{today.year-1}0930"
 
+def to_arrow_dtypes(df):
+    """安装了 pyarrow 时把各列转换为 Arrow 类型，字符串不再逐个存为Python对象；否则原样返回"""
+    try:
+        return df.convert_dtypes(dtype_backend='pyarrow')
+    except ImportError:
+        return df
+
 def test_balance_sheet(db):
     """测试资产负债表数据获取和保存"""
     date = get_quarter_end_date()
@@ -44,7 +88,7 @@ def test_balance_sheet(db):
     
     try:
         # 获取资产负债表数据
-        df = ak.stock_zcfz_em(date=date)
+        df = to_arrow_dtypes(ak.stock_zcfz_em(date=date))
         print("\n获取资产负债表数据成功！")
         
         print("\n原始数据预览：")
@@ -56,19 +100,8 @@ def test_balance_sheet(db):
         print("\n数据形状：")
         print(df.shape)
         
-        # 转换列名
-        column_mapping = {
-            '资产-货币资金': '资产货币资金',
-            '资产-应收账款': '资产应收账款',
-            '资产-存货': '资产存货',
-            '资产-总资产': '资产总资产',
-            '资产-总资产同比': '资产总资产同比',
-            '负债-应付账款': '负债应付账款',
-            '负债-预收账款': '负债预收账款',
-            '负债-总负债': '负债总负债',
-            '负债-总负债同比': '负债总负债同比'
-        }
-        df = df.rename(columns=column_mapping)
+        # 转换列名，原地修改不复制数据
+        df.rename(columns=BS_COLUMN_MAP, inplace=True)
         
         # 保存数据到数据库
         db.save_balance_sheet(df)
@@ -89,6 +122,7 @@ def test_income_statement(db):
             return
             
         logging.info(f"成功获取利润表数据，包含 {len(df)} 条记录")
+        df = to_arrow_dtypes(df)
         
         logging.info("\n原始数据预览：")
         logging.info(df.head())
@@ -106,24 +140,17 @@ def test_income_statement(db):
             logging.error(f"利润表数据缺少必要列: {missing_columns}")
             return
             
-        # 转换列名
-        column_mapping = {
-            '营业总支出-营业支出': '营业总支出营业支出',
-            '营业总支出-销售费用': '营业总支出销售费用',
-            '营业总支出-管理费用': '营业总支出管理费用',
-            '营业总支出-财务费用': '营业总支出财务费用',
-            '营业总支出-营业总支出': '营业总支出营业总支出'
-        }
-        df = df.rename(columns=column_mapping)
+        # 转换列名，原地修改不复制数据
+        df.rename(columns=IS_COLUMN_MAP, inplace=True)
         
         # 检查数据质量
         if df['股票代码'].isnull().any():
             logging.warning("存在股票代码为空的数据")
-            df = df.dropna(subset=['股票代码'])
+            df.dropna(subset=['股票代码'], inplace=True)
             
         if df['公告日期'].isnull().any():
             logging.warning("存在公告日期为空的数据")
-            df = df.dropna(subset=['公告日期'])
+            df.dropna(subset=['公告日期'], inplace=True)
             
         # 保存数据到数据库
         db.save_income_statement(df)
@@ -147,7 +174,7 @@ def test_cash_flow(db):
     
     try:
         # 获取现金流量表数据
-        df = ak.stock_xjll_em(date=date)
+        df = to_arrow_dtypes(ak.stock_xjll_em(date=date))
         print("\n获取现金流量表数据成功！")
         
         print("\n原始数据预览：")
@@ -159,18 +186,8 @@ def test_cash_flow(db):
         print("\n数据形状：")
         print(df.shape)
         
-        # 转换列名
-        column_mapping = {
-            '净现金流-净现金流': '净现金流净现金流',
-            '净现金流-同比增长': '净现金流同比增长',
-            '经营性现金流-现金流量净额': '经营性现金流现金流量净额',
-            '经营性现金流-净现金流占比': '经营性现金流净现金流占比',
-            '投资性现金流-现金流量净额': '投资性现金流现金流量净额',
-            '投资性现金流-净现金流占比': '投资性现金流净现金流占比',
-            '融资性现金流-现金流量净额': '融资性现金流现金流量净额',
-            '融资性现金流-净现金流占比': '融资性现金流净现金流占比'
-        }
-        df = df.rename(columns=column_mapping)
+        # 转换列名，原地修改不复制数据
+        df.rename(columns=CF_COLUMN_MAP, inplace=True)
         
         # 保存数据到数据库
         db.save_cash_flow(df)
@@ -182,17 +199,12 @@ def test_data_retrieval(db):
     """测试从数据库读取保存的数据"""
     print("\n从数据库读取保存的数据：")
     
-    print("\n资产负债表数据：")
-    df_bs = db.get_balance_sheet()
-    print(df_bs)
-    
-    print("\n利润表数据：")
-    df_is = db.get_income_statement()
-    print(df_is)
-    
-    print("\n现金流量表数据：")
-    df_cf = db.get_cash_flow()
-    print(df_cf)
+    # 只取记录数与前几行预览，不把整张表读入内存再格式化输出
+    for title, table in (('资产负债表', 'balance_sheet'),
+                         ('利润表', 'income_statement'),
+                         ('现金流量表', 'cash_flow')):
+        print(f"\n{title}数据（共 {db.count(table)} 条记录）：")
+        print(db.head(table))
 
 def main():
     setup_logging()
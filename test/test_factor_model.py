@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 与 main.py 相同，模块之间按文件名直接导入
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from factor_model import FactorModel
+
+
+@pytest.fixture(autouse=True)
+def _isolated_cwd(tmp_path, monkeypatch):
+    """FactorModel 会在当前目录下打开 data/SH/financial_data.db，测试在临时目录中运行，不改动仓库中的数据库"""
+    monkeypatch.chdir(tmp_path)
+
+
+def _model_with_scores(scores):
+    """构造只设置了最终得分的因子模型"""
+    model = FactorModel()
+    model.final_scores = pd.Series(scores, index=[f"{i:06d}" for i in range(len(scores))], dtype=float)
+    return model
+
+
+def test_select_top_stocks_ties_at_cutoff_match_nlargest():
+    """第n名得分并列时，与 nlargest(n) 一样选择排在前面的股票"""
+    # 000000 与 000002 并列第3名，应选择排在前面的 000000
+    model = _model_with_scores([-1.0, 0.5, -1.0, -3.0, 0.5])
+
+    result = model.select_top_stocks(3)
+
+    assert result == list(model.final_scores.nlargest(3).items())
+    assert [code for code, _ in result] == ['000001', '000004', '000000']
+
+
+def test_select_top_stocks_tie_order_within_selection():
+    """入选股票中得分相同的按原顺序排列"""
+    # 无效因子的股票得分均为-3
+    model = _model_with_scores([-1.0, -1.0, -3.0, -3.0, -3.0, -3.0, -3.0, -3.0, 0.5, -1.0])
+
+    result = model.select_top_stocks(3)
+
+    assert result == list(model.final_scores.nlargest(3).items())
+    assert [code for code, _ in result] == ['000008', '000000', '000001']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_select_top_stocks_matches_nlargest_with_ties_and_nan(seed):
+    """得分大量并列且含NaN时，结果与 nlargest(n) 完全一致"""
+    rng = np.random.default_rng(seed)
+    scores = rng.integers(-3, 3, 40).astype(float)
+    scores[rng.random(40) < 0.2] = np.nan
+    model = _model_with_scores(scores)
+
+    for n in (1, 3, 10, 35):
+        expected = list(model.final_scores.nlargest(n).items())
+        assert str(model.select_top_stocks(n)) == str(expected)
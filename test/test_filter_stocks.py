@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# 与 main.py 相同，模块之间按文件名直接导入
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from data_processor import DataProcessor
+
+# 常规6位代码之外，包含位数不足、丢失前导零、含非数字字符与可解析为小数的代码
+CODES = ['000001', '300750', '688001', '600000', '301000', '680000',
+         '30', '3001', '68', '6801', '1', '30ABCD', 'sh6000', '300.00', '68.000', '６０００００']
+
+
+def _stock_list():
+    """构造包含各类代码的股票列表，索引不从0开始"""
+    names = [f'股票{i}' for i in range(len(CODES))]
+    names[3] = '*ST 浦发'
+    names[5] = 'st 测试'
+    return pd.DataFrame({'code': CODES, 'name': names}, index=range(10, 10 + len(CODES)))
+
+
+def _string_filter(stock_list, prefixes):
+    """按字符串前缀剔除的原始实现，作为对照"""
+    mask = ~stock_list['code'].str.startswith(prefixes)
+    mask &= ~stock_list['name'].str.upper().str.contains('ST', regex=False)
+    return stock_list[mask]
+
+
+def test_data_processor_filter_matches_string_prefix():
+    """位数不足或含非数字字符的代码与字符串前缀匹配的结果一致"""
+    stock_list = _stock_list()
+    # filter_stocks 不访问数据库，不必打开数据库连接
+    processor = DataProcessor.__new__(DataProcessor)
+
+    result = processor.filter_stocks(stock_list)
+
+    pd.testing.assert_frame_equal(result, _string_filter(stock_list, '30'))
+    assert '30' not in result['code'].tolist()
+    assert '3001' not in result['code'].tolist()
+    assert '30ABCD' not in result['code'].tolist()
+    assert 'sh6000' in result['code'].tolist()
+
+
+def test_main_filter_matches_string_prefix():
+    """main.filter_stocks 同时剔除30与68开头的代码，短代码同样剔除"""
+    pytest.importorskip('akshare')
+    import main
+    stock_list = _stock_list()
+
+    result = main.filter_stocks(stock_list)
+
+    pd.testing.assert_frame_equal(result, _string_filter(stock_list, ('30', '68')))
+    assert not set(result['code']) & {'30', '3001', '68', '6801', '300.00', '68.000'}